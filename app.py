@@ -1,33 +1,79 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 import os
+import json
+import logging
+import math
 import base64
 from io import BytesIO
 from PIL import Image
-from datetime import datetime
-
-from models.detection import run_object_detection
-
-from models.sketch_diffusion import sketch_to_image
-from models.gan_playground import generate_gan_image
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import instrumentation
+from instrumentation import stage, gauge, render_metrics
+
+# configured before the model imports so their import-time messages are kept
+instrumentation.setup_logging()
+
+from models.detection import run_object_detection, to_working
+from models.result_cache import result_cache
+from models.batching import scheduler_stats
+from models.workers import in_worker, start_worker_pools, worker_pool_stats
+from models.image_io import ImageInput
+from models.registry import model_registry
+from models.preload import memory_usage, preloaded
+from models.segmentation import run_segmentation
+from models.edit_engine import apply_edits
+from models.mask_encoding import encode_segments, MASK_FORMATS
+from models.sprites import extract_sprites, pack_atlas
+from models.diffusion_jobs import diffusion_jobs, QueueFull, PRIORITIES, NORMAL, DONE, QUEUED, RUNNING, CANCELLED
+from models.diffusion_pools import noise_pools
+from edit_sessions import edit_sessions, scale_actions
+from storage import ContentStore
+from responses import pil_to_base64, image_response, negotiate_encoding, EncodedImage
+
+from models.sketch_diffusion import (sketch_to_image_stream, diffusion_cache, prompt_cache, QUALITY_TIERS,
+                                     DEFAULT_PROMPT, PURIFY_PROMPT, MONSTER_PROMPT)
+from models.gan_playground import (generate_gan_image, generate_gan_images, make_grid,
+                                   encode_animation, GAN_MODES, GAN_MAX_BATCH, IMAGE_SIZE)
 
 app = Flask(__name__)
+instrumentation.init_app(app)
+log = logging.getLogger(__name__)
 app.config["UPLOAD_FOLDER"] = "uploads"
+# Keep a copy of every upload on disk (written off the request thread)
+app.config["ARCHIVE_UPLOADS"] = os.environ.get("ARCHIVE_UPLOADS", "0") == "1"
 
-os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+# Archived uploads are stored once per distinct content and expire after
+# UPLOAD_RETENTION_HOURS without a re-upload, or sooner when the archive
+# grows past UPLOAD_STORE_MB (see storage.py). Model worker processes
+# import this module only for its model setup and build neither store.
+upload_store = None if in_worker else ContentStore(
+    app.config["UPLOAD_FOLDER"],
+    max_bytes=int(float(os.environ.get("UPLOAD_STORE_MB", "1024")) * 2**20),
+    max_age=float(os.environ.get("UPLOAD_RETENTION_HOURS", "168")) * 3600,
+)
 
+_archive_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="upload-archive")
 
-def save_uploaded_image(file_storage, prefix="img"):
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    filename = f"{prefix}_{ts}.png"
-    path = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-    file_storage.save(path)
-    return path
 
+def save_uploaded_image(data):
+    """Archive upload bytes in the upload store; returns the stored file's path."""
+    return upload_store.path(upload_store.put(data))
 
-def pil_to_base64(img: Image.Image) -> str:
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+def read_uploaded_image(file_storage):
+    """
+    Read an upload into memory. The returned ImageInput is decoded at most
+    once and shared by PIL and the models; archiving to UPLOAD_FOLDER is
+    optional and happens in the background.
+    """
+    with stage("upload"):
+        data = file_storage.read()
+    if app.config["ARCHIVE_UPLOADS"]:
+        _archive_executor.submit(save_uploaded_image, data)
+    return ImageInput(data=data)
 
 
 @app.route("/")
@@ -39,27 +85,101 @@ def test_canvas():
     return render_template("test_canvas.html")
 
 
+@app.route("/api/ready", methods=["GET"])
+def api_ready():
+    """Readiness probe: which models are loaded and whether warm-up finished."""
+    status = model_registry.status()
+    return jsonify(status), (200 if status["ready"] else 503)
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+def api_cache_stats():
+    """Hit/miss counters of the vision result cache, the diffusion image cache
+    and the prompt embedding cache (with text-encoder timings)."""
+    return jsonify(dict(result_cache.stats(), diffusion=diffusion_cache.stats(),
+                        prompt_embeddings=prompt_cache.stats()))
+
+
+def _queue_depths():
+    depths = {(name,): s["queue_depth"] for name, s in scheduler_stats().items()}
+    depths[("diffusion",)] = diffusion_jobs.stats()["queue_depth"]
+    return depths
+
+
+# Scraped by /metrics, next to the latency histograms in instrumentation.py
+gauge("queue_depth", "Items waiting per queue", _queue_depths, labelnames=("queue",))
+gauge("cache_hit_rate", "Hit rate per cache", lambda: {
+    ("vision",): result_cache.stats()["hit_rate"],
+    ("diffusion",): diffusion_cache.stats()["hit_rate"],
+    ("prompt_embeddings",): prompt_cache.stats()["hit_rate"],
+}, labelnames=("cache",))
+gauge("noise_pool_depth", "Pre-generated images ready per pool",
+      lambda: {(name,): s["depth"] for name, s in noise_pools.stats().items()}, labelnames=("pool",))
+gauge("edit_sessions", "Open edit sessions", lambda: edit_sessions.stats()["sessions"])
+gauge("models_loaded", "Models currently in memory",
+      lambda: sum(1 for m in model_registry.status()["models"].values() if m["loaded"]))
+gauge("model_workers_alive", "Live model worker processes per family", lambda: {
+    (name,): sum(1 for w in s["workers"] if w["alive"]) for name, s in worker_pool_stats().items()
+}, labelnames=("family",))
+gauge("process_memory_bytes", "Memory of this server process: rss, pss, shared and private (unique)",
+      lambda: {(kind,): value for kind, value in memory_usage().items()}, labelnames=("kind",))
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus text exposition: latency histograms, queue depths, cache hit rates."""
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/batching/stats", methods=["GET"])
+def api_batching_stats():
+    """Queue depth and batch-size histograms of the YOLO batch schedulers."""
+    return jsonify(scheduler_stats())
+
+
+@app.route("/api/storage/stats", methods=["GET"])
+def api_storage_stats():
+    """Size, file count, dedup hits and GC counters of the upload and boss stores."""
+    return jsonify({"uploads": upload_store.stats(), "boss": boss_catalog.store.stats()})
+
+
+@app.route("/api/memory", methods=["GET"])
+def api_memory():
+    """This worker's unique vs shared memory, and the models preloaded before the fork."""
+    usage = memory_usage()
+    return jsonify(dict({f"{k}_mb": round(v / 2**20, 1) for k, v in usage.items()},
+                        pid=os.getpid(), preloaded=preloaded))
+
+
+@app.route("/api/workers/stats", methods=["GET"])
+def api_worker_stats():
+    """Model worker processes (MODEL_WORKERS): pids, pinned CPUs, batches, crashes."""
+    return jsonify(worker_pool_stats())
+
+
 # ========== 1) OBJECT REMOVAL ARENA ==========
 
 @app.route("/api/detect_objects", methods=["POST"])
 def api_detect_objects():
     """
-    Input: image file
-    Output: detected bboxes with labels & scores
+    Input: image file; session=1 also opens an edit session
+    Output: detected bboxes with labels & scores, plus (with session=1) the
+    edit session 'handle' for /api/edit_session/<handle>/...
     """
     if "image" not in request.files:
         return jsonify({"error": "No image"}), 400
 
-    path = save_uploaded_image(request.files["image"], prefix="det")
-    detections, annotated_img = run_object_detection(path)
+    image = read_uploaded_image(request.files["image"])
+    detections, annotated_img = run_object_detection(image)
 
-    # return annotated image + bbox metadata
-    annotated_b64 = pil_to_base64(annotated_img)
+    payload = {"bboxes": detections, "original_size": list(image.original_size)}
+    if request.values.get("session") in ("1", "true"):
+        payload["handle"] = edit_sessions.create(np.array(annotated_img), image.scale)
 
-    return jsonify({
-        "bboxes": detections,
-        "annotated_image": annotated_b64
-    })
+    # return annotated image + bbox metadata; bboxes are in the upload's
+    # pixels (original_size), annotated_image is the upload shrunk to
+    # MAX_INPUT_SIDE if it was larger
+    return image_response(payload, {"annotated_image": annotated_img})
 
 
 @app.route("/api/object_edit", methods=["POST"])
@@ -71,7 +191,9 @@ def api_object_edit():
       "actions": [
          {"bbox": [x1,y1,x2,y2], "action": "remove"},
          {"bbox": [...], "action": "keep"}
-      ]
+      ],
+      "original_size": [w, h]   optional: bboxes are in pixels of an image
+                                of this size (e.g. from /api/detect_objects)
     }
     Output: edited image (inpainted / blurred regions)
     """
@@ -85,82 +207,84 @@ def api_object_edit():
     img_bytes = base64.b64decode(img_b64)
     img = Image.open(BytesIO(img_bytes)).convert("RGB")
 
-    import cv2
-    import numpy as np
+    # Inpainting and resizing are channel-order agnostic, so edit the RGB
+    # pixels directly in one writable buffer
+    if data.get("original_size"):
+        ow, oh = data["original_size"]
+        actions = scale_actions(actions, (ow / img.width, oh / img.height))
 
-    cv_img = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
+    pixels = np.array(img)
+    with stage("edit"):
+        apply_edits(pixels, actions)
+    edited_img = Image.fromarray(pixels)
+
+    return image_response({}, {"edited_image": edited_img})
+
+
+def _session_tile_response(session, rects):
+    """Only the changed regions of the session image, with their offsets."""
+    payload = {"handle": session.handle, "version": session.version,
+               "changed": bool(rects), "tiles": []}
+    images = {}
+    for i, (x1, y1, x2, y2) in enumerate(rects):
+        name = f"tile_{i}"
+        payload["tiles"].append({"image": name, "offset": [x1, y1], "size": [x2 - x1, y2 - y1]})
+        images[name] = Image.fromarray(session.pixels[y1:y2, x1:x2])
+    return image_response(payload, images)
+
+
+@app.route("/api/edit_session/<handle>/edit", methods=["POST"])
+def api_edit_session_edit(handle):
+    """
+    Apply bbox actions to the server-held image of a session.
+    Input: {"actions": [...]} (same format as /api/object_edit)
+    Output: the new version and one tile per changed region: "tiles" lists
+    their offset/size and the field holding each tile image
+    """
+    session = edit_sessions.get(handle)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    data = request.get_json()
+    if not data or "actions" not in data:
+        return jsonify({"error": "Invalid payload"}), 400
+
+    with session.lock:
+        with stage("edit"):
+            rects = session.apply(data["actions"])
+        return _session_tile_response(session, rects)
+
+
+@app.route("/api/edit_session/<handle>/undo", methods=["POST"])
+def api_edit_session_undo(handle):
+    session = edit_sessions.get(handle)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    with session.lock:
+        return _session_tile_response(session, session.undo())
+
+
+@app.route("/api/edit_session/<handle>/redo", methods=["POST"])
+def api_edit_session_redo(handle):
+    session = edit_sessions.get(handle)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    with session.lock:
+        return _session_tile_response(session, session.redo())
+
+
+@app.route("/api/edit_session/<handle>", methods=["GET", "DELETE"])
+def api_edit_session(handle):
+    """GET: the full current image. DELETE: drop the session."""
+    if request.method == "DELETE":
+        return jsonify({"success": edit_sessions.close(handle)})
+
+    session = edit_sessions.get(handle)
+    if session is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+    with session.lock:
+        img = Image.fromarray(session.pixels)
+        return image_response({"handle": handle, "version": session.version}, {"image": img})
 
-    # Process removals with stretch-based filling
-    for act in actions:
-        x1, y1, x2, y2 = act["bbox"]
-        action = act["action"]
-        scale = act.get("scale", 1.0)
-        
-        # Ensure coordinates are within bounds
-        h, w, _ = cv_img.shape
-        x1, y1 = max(0, x1), max(0, y1)
-        x2, y2 = min(w, x2), min(h, y2)
-        
-        roi_width = x2 - x1
-        roi_height = y2 - y1
-        
-        if roi_width <= 0 or roi_height <= 0:
-            continue
-            
-        if action == "remove":
-            # Use cv2 inpainting for more natural results
-            # Create a mask for this specific object
-            mask = np.zeros(cv_img.shape[:2], dtype=np.uint8)
-            cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
-            
-            # Use Navier-Stokes based inpainting with a good radius
-            # This fills the area by considering surrounding pixels
-            cv_img = cv2.inpaint(cv_img, mask, inpaintRadius=7, flags=cv2.INPAINT_NS)
-
-        elif action == "scale" and scale != 1.0:
-            # Extract the region
-            roi = cv_img[y1:y2, x1:x2].copy()
-            if roi.size > 0:
-                # Calculate new size
-                new_w = int((x2 - x1) * scale)
-                new_h = int((y2 - y1) * scale)
-                
-                if new_w > 0 and new_h > 0:
-                    # Resize the ROI
-                    scaled_roi = cv2.resize(roi, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
-                    
-                    # Calculate center position to place scaled ROI
-                    center_x = (x1 + x2) // 2
-                    center_y = (y1 + y2) // 2
-                    new_x1 = max(0, center_x - new_w // 2)
-                    new_y1 = max(0, center_y - new_h // 2)
-                    new_x2 = min(cv_img.shape[1], new_x1 + new_w)
-                    new_y2 = min(cv_img.shape[0], new_y1 + new_h)
-                    
-                    # Adjust if scaled ROI goes out of bounds
-                    actual_w = new_x2 - new_x1
-                    actual_h = new_y2 - new_y1
-                    
-                    if actual_w > 0 and actual_h > 0:
-                        # Fill the original region with stretch first (to "remove" the old object)
-                        # Reuse the same stretch logic as above
-                        if x1 > 0:
-                            sample_pixels = cv_img[y1:y2, x1-1:x1]
-                            filled_roi = cv2.resize(sample_pixels, (roi_width, roi_height), interpolation=cv2.INTER_NEAREST)
-                            cv_img[y1:y2, x1:x2] = filled_roi
-                        elif x2 < w:
-                            sample_pixels = cv_img[y1:y2, x2:x2+1]
-                            filled_roi = cv2.resize(sample_pixels, (roi_width, roi_height), interpolation=cv2.INTER_NEAREST)
-                            cv_img[y1:y2, x1:x2] = filled_roi
-                        
-                        # Place the scaled ROI
-                        cv_img[new_y1:new_y2, new_x1:new_x2] = scaled_roi[:actual_h, :actual_w]
-
-    edited_img = Image.fromarray(cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB))
-    edited_b64 = pil_to_base64(edited_img)
-
-    return jsonify({"edited_image": edited_b64})
-    
 
 @app.route("/api/sketch_to_image", methods=["POST"])
 def api_sketch_to_image():
@@ -172,16 +296,172 @@ def api_sketch_to_image():
 
     guidance_scale = float(request.form.get("guidance_scale", 3.0))
     num_steps = int(request.form.get("num_steps", 15))
-    prompt = request.form.get("prompt", "a cute digital art, clean, high quality")
+    prompt = request.form.get("prompt", DEFAULT_PROMPT)
+    style = request.form.get("style", "cartoon")  # fallback preset, see models/stylize.py
+    # "preview" is fast and low-res; "refine" upscales the preview (send the
+    # seed the preview returned to reuse it)
+    quality = request.form.get("quality", "full")
+    if quality not in QUALITY_TIERS:
+        return jsonify({"error": f"quality must be one of {', '.join(QUALITY_TIERS)}"}), 400
+
+    image = read_uploaded_image(request.files["image"])
+    return _diffusion_response(image, "generated_image",
+                               guidance_scale=guidance_scale,
+                               num_inference_steps=num_steps,
+                               prompt=prompt,  # Pass the user's prompt
+                               style=style,
+                               quality=quality)
+
+
+def _diffusion_response(source, result_key, **params):
+    """
+    Run a sketch_to_image call through the diffusion job queue.
+    With async=1 the request returns 202 and a job id right away (poll it
+    on the same server process, see models/diffusion_jobs.py); otherwise
+    it waits for the job. A full queue answers 429.
+    Optional 'priority': high | normal | low, and 'seed' for reproducible
+    (and cacheable) results; the seed used is returned as "seed".
+    """
+    priority = PRIORITIES.get(request.values.get("priority", "normal"), NORMAL)
+    try:
+        seed = _request_seed()
+    except ValueError:
+        return jsonify({"error": "seed must be an integer"}), 400
+    is_async = request.values.get("async") in ("1", "true")
+    try:
+        job = diffusion_jobs.submit(source, priority=priority, track=is_async,
+                                    meta={"result_key": result_key}, seed=seed, **params)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
+
+    if is_async:
+        return jsonify({
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": f"/api/jobs/{job.id}",
+            "result_url": f"/api/jobs/{job.id}/result"
+        }), 202
+
+    img = job.wait()
+    info = job.info()
+    instrumentation.record_stage("queue", info["queue_wait"])
+    instrumentation.record_stage("inference", info["run_time"] or 0.0)
+    return image_response(_seed_payload(img), {result_key: img})
+
+
+def _request_seed():
+    """Optional integer 'seed' field; None when absent."""
+    seed = request.values.get("seed")
+    return int(seed) if seed not in (None, "") else None
+
+
+def _seed_payload(img):
+    seed = img.info.get("seed")
+    return {"seed": seed} if seed is not None else {}
+
+
+# ========== DIFFUSION JOBS ==========
+
+@app.route("/api/jobs/<job_id>", methods=["GET", "DELETE"])
+def api_job_status(job_id):
+    """GET: job status and timings. DELETE: cancel a job that has not started."""
+    job = diffusion_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if request.method == "DELETE":
+        return jsonify({"cancelled": diffusion_jobs.cancel(job_id)})
+    return jsonify(job.info())
+
+
+@app.route("/api/jobs/<job_id>/result", methods=["GET"])
+def api_job_result(job_id):
+    job = diffusion_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    if job.status in (QUEUED, RUNNING):
+        return jsonify(job.info()), 202
+    if job.status == CANCELLED:
+        return jsonify(job.info()), 409
+    if job.status != DONE:
+        return jsonify(job.info()), 500
+    payload = dict(_seed_payload(job.result), job_id=job.id)
+    return image_response(payload, {job.meta["result_key"]: job.result})
+
+
+@app.route("/api/jobs/stats", methods=["GET"])
+def api_job_stats():
+    """Queue depth, queue-wait and run-time metrics of the diffusion workers."""
+    return jsonify(diffusion_jobs.stats())
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route("/api/sketch_to_image/stream", methods=["POST"])
+def api_sketch_to_image_stream():
+    """
+    Server-Sent Events variant of /api/sketch_to_image.
+    Same inputs, plus 'preview_every' (steps between previews, default 2).
+    Runs on the diffusion job queue ('priority' as for the other diffusion
+    endpoints); a full queue answers 429 before the stream starts.
+    Events:
+      progress  {"step", "total", "preview"?}  preview: low-res base64 image
+      done      {"generated_image", "seed"?}
+      error     {"error"}
+    Disconnecting cancels the job, or aborts it after the current step.
+    """
+    if "image" not in request.files:
+        return jsonify({"error": "No image"}), 400
+
+    guidance_scale = float(request.form.get("guidance_scale", 3.0))
+    num_steps = int(request.form.get("num_steps", 15))
+    prompt = request.form.get("prompt", DEFAULT_PROMPT)
+    preview_every = int(request.form.get("preview_every", 2))
+    style = request.form.get("style", "cartoon")
+    try:
+        seed = _request_seed()
+    except ValueError:
+        return jsonify({"error": "seed must be an integer"}), 400
+    encoding = negotiate_encoding()
 
-    path = save_uploaded_image(request.files["image"], prefix="sketch")
-    out_img = sketch_to_image(path,
-                              guidance_scale=guidance_scale,
-                              num_inference_steps=num_steps,
-                              prompt=prompt)  # Pass the user's prompt
-    out_b64 = pil_to_base64(out_img)
+    priority = PRIORITIES.get(request.values.get("priority", "normal"), NORMAL)
 
-    return jsonify({"generated_image": out_b64})
+    image = read_uploaded_image(request.files["image"])
+    try:
+        events = sketch_to_image_stream(image,
+                                        preview_every=preview_every,
+                                        priority=priority,
+                                        guidance_scale=guidance_scale,
+                                        num_inference_steps=num_steps,
+                                        prompt=prompt,
+                                        style=style,
+                                        seed=seed)
+    except QueueFull as e:
+        return jsonify({"error": str(e)}), 429, {"Retry-After": "5"}
+
+    def generate():
+        # closing this generator (client gone) closes `events`, which
+        # cancels the job
+        with closing(events):
+            for event in events:
+                if event[0] == "keepalive":
+                    # SSE comment: ignored by clients, but detects a disconnect
+                    yield ": keepalive\n\n"
+                elif event[0] == "progress":
+                    _, step, total, preview = event
+                    data = {"step": step, "total": total}
+                    if preview is not None:
+                        data["preview"] = encoding.to_base64(preview)
+                    yield _sse("progress", data)
+                elif event[0] == "done":
+                    data = dict(_seed_payload(event[1]), generated_image=encoding.to_base64(event[1]))
+                    yield _sse("done", data)
+                else:
+                    yield _sse("error", {"error": event[1]})
+
+    return Response(generate(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 # ========== 3) GAN PLAYGROUND ==========
@@ -190,15 +470,42 @@ def api_sketch_to_image():
 def api_gan_generate():
     """
     Input: latent_dim, noise_scale
+    Batch mode (all optional):
+      count     number of images, generated in one forward pass (default 1)
+      mode      "samples" | "interpolate" (a latent-space walk)
+      layout    "grid" (sprite sheet, default) | "webp" (animated WebP)
+      columns   grid columns; frame_ms: WebP frame duration
     """
     data = request.get_json()
     latent_dim = int(data.get("latent_dim", 16))
     noise_scale = float(data.get("noise_scale", 1.0))
-
-    img = generate_gan_image(latent_dim=latent_dim,
-                             noise_scale=noise_scale)
-    img_b64 = pil_to_base64(img)
-    return jsonify({"generated_image": img_b64})
+    count = int(data.get("count", 1))
+    mode = data.get("mode", "samples")
+    layout = data.get("layout", "grid")
+
+    if count == 1 and mode == "samples":
+        img = generate_gan_image(latent_dim=latent_dim,
+                                 noise_scale=noise_scale)
+        return image_response({}, {"generated_image": img})
+
+    if not 1 <= count <= GAN_MAX_BATCH:
+        return jsonify({"error": f"count must be between 1 and {GAN_MAX_BATCH}"}), 400
+    if mode not in GAN_MODES or layout not in ("grid", "webp"):
+        return jsonify({"error": "Unknown mode or layout"}), 400
+
+    frames = generate_gan_images(latent_dim=latent_dim, noise_scale=noise_scale,
+                                 count=count, mode=mode)
+    payload = {"count": count, "mode": mode, "layout": layout,
+               "frame_size": [IMAGE_SIZE, IMAGE_SIZE]}
+    if layout == "webp":
+        frame_ms = int(data.get("frame_ms", 80))
+        payload["frame_ms"] = frame_ms
+        img = EncodedImage(data=encode_animation(frames, frame_ms))
+    else:
+        columns = max(1, min(count, int(data.get("columns", 0)) or int(math.ceil(math.sqrt(count)))))
+        payload["columns"] = columns
+        img = make_grid(frames, columns)
+    return image_response(payload, {"generated_image": img})
 
 
 #========== 4) BOSS BATTLE ==========
@@ -206,57 +513,45 @@ def api_gan_generate():
 BOSS_UPLOAD_FOLDER = "boss_uploads"
 os.makedirs(BOSS_UPLOAD_FOLDER, exist_ok=True)
 
+from boss_catalog import BossCatalog, IMAGE_EXTENSIONS, READY
+
+boss_catalog = None if in_worker else BossCatalog(BOSS_UPLOAD_FOLDER, encode=pil_to_base64)
+
+
 @app.route("/api/boss/upload", methods=["POST"])
 def api_boss_upload():
-    """Upload a custom boss image"""
+    """Upload a custom boss image; its analysis runs in the background"""
     if "image" not in request.files:
         return jsonify({"error": "No image part"}), 400
     file = request.files["image"]
     if file.filename == "":
         return jsonify({"error": "No selected file"}), 400
-        
-    # Save file
-    filename = f"boss_{datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    path = os.path.join(BOSS_UPLOAD_FOLDER, filename)
-    file.save(path)
-    
-    return jsonify({"success": True, "path": path})
+
+    ext = os.path.splitext(file.filename)[1].lower()
+    if ext not in IMAGE_EXTENSIONS:
+        ext = ".png"
+    boss_id = boss_catalog.register(file.read(), ext)
+    entry = boss_catalog.get_nowait(boss_id)
+
+    return jsonify({"success": True, "id": boss_id, "path": entry["path"]})
 
 @app.route("/api/boss/start", methods=["GET"])
 def api_boss_start():
     """
-    Start a new boss battle using images from boss_uploads
+    Start a new boss battle using a precomputed entry of the boss catalog
     """
     import random
-    import glob
-    from models.detection import run_pose_estimation, run_object_detection
-    
+
     try:
-        # Find all uploaded boss images
-        image_patterns = ["*.jpg", "*.jpeg", "*.png"]
-        all_images = []
-        for pattern in image_patterns:
-            all_images.extend(glob.glob(os.path.join(BOSS_UPLOAD_FOLDER, pattern)))
-        
-        if not all_images:
+        entry = boss_catalog.pick_random()
+        if entry is None:
             return jsonify({"error": "No boss images found. Please upload a boss image first!"}), 404
-        
-        # Select random image
-        image_path = random.choice(all_images)
-        print(f"DEBUG: Using boss image: {image_path}")
-        
-        # 1. Try Pose Estimation first (Best for Villains/Persons)
-        detections, _ = run_pose_estimation(image_path)
-        mode = "pose"
-        
-        # 2. Fallback to Object Detection if no skeletons found
-        if not detections:
-            print("DEBUG: No skeletons found, falling back to object detection")
-            detections, _ = run_object_detection(image_path)
-            mode = "object"
-            
-        print(f"DEBUG: Found {len(detections)} detections (Mode: {mode})")
-        
+        if entry["status"] != READY:
+            return jsonify({"error": f"Boss image analysis failed: {entry.get('error')}"}), 500
+
+        detections = entry["detections"]
+        log.debug("Using boss %s (%d detections, mode: %s)", entry["id"], len(detections), entry["mode"])
+
         # Extract unique labels from detections
         unique_labels = list(set([det["label"] for det in detections]))
         
@@ -267,62 +562,92 @@ def api_boss_start():
         else:
             targets = ["magic_orb"]
         
-        # Convert image to base64
-        from PIL import Image
-        img = Image.open(image_path)
-        img_b64 = pil_to_base64(img)
-        
-        return jsonify({
+        return image_response({
             "success": True,
-            "image": img_b64,
+            "id": entry["id"],
             "detections": detections,
             "targets": targets,
-            "mode": mode,  # Tell frontend which mode we are in
+            "mode": entry["mode"],  # Tell frontend which mode we are in
             "time_limit": 60
-        })
+        }, {"image": EncodedImage(b64=entry["image_b64"])})
     except Exception as e:
-        print(f"ERROR in boss start: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Boss start failed")
         return jsonify({"error": str(e)}), 500
 
 
 @app.route("/api/boss/analyze", methods=["POST"])
 def api_boss_analyze():
     """
-    Run Segmentation Analysis on the current boss image
+    Return the Segmentation Analysis of a boss image.
+    Input: 'id' of a catalog entry, or an 'image' file (registered on the fly).
+    Without either, the most recently uploaded boss is used.
+    Optional 'mask_format' (polygon|simplified|int16|rle) and 'tolerance'
+    select a compact mask encoding.
     """
+    mask_format = request.values.get("mask_format", "polygon")
+    tolerance = request.values.get("tolerance", 1.0, type=float)
+    if mask_format not in MASK_FORMATS:
+        return jsonify({"error": f"Unknown mask_format, expected one of {MASK_FORMATS}"}), 400
+
     try:
-        # Get image from request (or use last uploaded)
-        if "image" not in request.files:
-             # For now, let's just use the latest uploaded boss if no image provided
-             # But better to pass the image back or ID. 
-             # Simplest: Frontend sends the image blob back, or we just pick the latest file in boss_uploads
-             import glob
-             list_of_files = glob.glob(os.path.join(BOSS_UPLOAD_FOLDER, '*'))
-             if not list_of_files:
-                 return jsonify({"error": "No boss image found"}), 404
-             latest_file = max(list_of_files, key=os.path.getctime)
-             image_path = latest_file
+        if "image" in request.files:
+            boss_id = boss_catalog.register(request.files["image"].read())
         else:
-             # Save temp file
-             file = request.files["image"]
-             image_path = os.path.join(BOSS_UPLOAD_FOLDER, "temp_analyze.png")
-             file.save(image_path)
-             
-        from models.segmentation import run_segmentation
-        seg_results, overlay_img = run_segmentation(image_path)
-        
-        return jsonify({
+            boss_id = request.values.get("id") or boss_catalog.latest_id()
+        if boss_id is None:
+            return jsonify({"error": "No boss image found"}), 404
+
+        entry = boss_catalog.get(boss_id)
+        if entry is None:
+            return jsonify({"error": f"Unknown boss id: {boss_id}"}), 404
+        if entry["status"] != READY:
+            return jsonify({"error": f"Boss image analysis failed: {entry.get('error')}"}), 500
+
+        image_size = entry.get("image_size")
+        if image_size is None and mask_format == "rle":
+            image_size = Image.open(entry["path"]).size
+        segments = encode_segments(entry["segments"], mask_format, tolerance, image_size)
+
+        return image_response({
             "success": True,
-            "overlay_image": pil_to_base64(overlay_img),
-            "segments": seg_results
-        })
+            "id": boss_id,
+            "segments": segments
+        }, {"overlay_image": EncodedImage(b64=entry["overlay_b64"])})
     except Exception as e:
-        print(f"ERROR in analyze: {e}")
+        log.exception("Boss analyze failed")
         return jsonify({"error": str(e)}), 500
 
 
+def _blank_init():
+    return Image.new("RGB", (512, 512), (255, 255, 255))
+
+
+def _noise_init(seed=None):
+    return np.random.default_rng(seed).integers(0, 255, (512, 512, 3), dtype=np.uint8)
+
+
+# Requests without an init image or seed are served from these pools,
+# see models/diffusion_pools.py
+noise_pools.register("purify", _blank_init, prompt=PURIFY_PROMPT, strength=0.7)
+noise_pools.register("monster", _noise_init, prompt=MONSTER_PROMPT, strength=0.8)
+
+
+def _pooled_response(pool_name):
+    """Serve a pre-generated image, or None if the request needs its own generation."""
+    if "image" in request.files or request.values.get("seed"):
+        return None
+    img = noise_pools.take(pool_name)
+    if img is None:
+        return None
+    return image_response(dict(_seed_payload(img), pooled=True), {"image": img})
+
+
+@app.route("/api/noise/pools", methods=["GET"])
+def api_noise_pools():
+    """Depth, hit/miss counts and refill rate of the pre-generated image pools."""
+    return jsonify(noise_pools.stats())
+
+
 @app.route("/api/noise/purify", methods=["POST"])
 def api_noise_purify():
     """
@@ -330,23 +655,21 @@ def api_noise_purify():
     Input: 'image' (optional, noise pattern) or just prompt
     """
     try:
+        pooled = _pooled_response("purify")
+        if pooled is not None:
+            return pooled
+
         # If image provided, use it as init image (img2img)
-        # For now, let's just generate from text to keep it fast/simple if no image
-        prompt = "beautiful futuristic clean sci-fi city tile, isometric, high quality, glowing blue energy"
-        
         if "image" in request.files:
-             path = save_uploaded_image(request.files["image"], prefix="noise_init")
+             image = read_uploaded_image(request.files["image"])
         else:
              # Create a dummy blank image
-             dummy = Image.new("RGB", (512, 512), (255, 255, 255))
-             path = os.path.join(app.config["UPLOAD_FOLDER"], "dummy_noise.png")
-             dummy.save(path)
+             image = _blank_init()
              
-        out_img = sketch_to_image(path, prompt=prompt, strength=0.7)
-        return jsonify({"image": pil_to_base64(out_img)})
+        return _diffusion_response(image, "image", prompt=PURIFY_PROMPT, strength=0.7)
         
     except Exception as e:
-        print(f"ERROR in purify: {e}")
+        log.exception("Purify failed")
         return jsonify({"error": str(e)}), 500
 
 @app.route("/api/noise/monster", methods=["POST"])
@@ -355,23 +678,21 @@ def api_noise_monster():
     Generate a monster sprite from noise
     """
     try:
-        prompt = "scary glitch monster, pixel art, dark void creature, red eyes, detailed"
-        
+        pooled = _pooled_response("monster")
+        if pooled is not None:
+            return pooled
+
         if "image" in request.files:
-             path = save_uploaded_image(request.files["image"], prefix="monster_init")
+             image = read_uploaded_image(request.files["image"])
         else:
-             # Create a dummy noise image using numpy
-             import numpy as np
-             noise_arr = np.random.randint(0, 255, (512, 512, 3), dtype=np.uint8)
-             dummy = Image.fromarray(noise_arr)
-             path = os.path.join(app.config["UPLOAD_FOLDER"], "dummy_monster.png")
-             dummy.save(path)
+             # Create a dummy noise image using numpy; seeded requests get
+             # the same noise, so their result is cacheable
+             image = _noise_init(_request_seed())
              
-        out_img = sketch_to_image(path, prompt=prompt, strength=0.8)
-        return jsonify({"image": pil_to_base64(out_img)})
+        return _diffusion_response(image, "image", prompt=MONSTER_PROMPT, strength=0.8)
         
     except Exception as e:
-        print(f"ERROR in monster: {e}")
+        log.exception("Monster generation failed")
         return jsonify({"error": str(e)}), 500
 
 
@@ -382,80 +703,73 @@ def api_noise_monster():
 def api_target_tagger_sprites():
     """
     Upload an image, segment it, and return individual sprites.
+    With layout=atlas the sprites come packed into one RGBA texture and
+    'frames' maps each sprite to its x/y/width/height inside it.
     """
     try:
         if "image" not in request.files:
             return jsonify({"error": "No image uploaded"}), 400
             
         file = request.files["image"]
-        path = save_uploaded_image(file, prefix="target_source")
-        
-        from models.segmentation import run_segmentation
-        import cv2
-        import numpy as np
+        image = read_uploaded_image(file)
         
         # Run segmentation
-        seg_results, _ = run_segmentation(path)
+        seg_results, _ = run_segmentation(image)
         
         if not seg_results:
             return jsonify({"error": "No objects found in image"}), 404
             
-        # Load original image for cropping
-        orig_img = cv2.imread(path)
-        orig_img = cv2.cvtColor(orig_img, cv2.COLOR_BGR2RGB)
-        
-        sprites = []
-        
-        for i, res in enumerate(seg_results):
-            mask_pts = np.array(res["mask"]).astype(np.int32)
-            bbox = res["bbox"] # x1, y1, x2, y2
-            label = res["label"]
-            
-            # Create a mask for this object
-            mask = np.zeros(orig_img.shape[:2], dtype=np.uint8)
-            cv2.fillPoly(mask, [mask_pts], 255)
-            
-            # Crop to bbox
-            x1, y1, x2, y2 = bbox
-            # Add some padding
-            pad = 5
-            h, w = orig_img.shape[:2]
-            x1 = max(0, x1 - pad)
-            y1 = max(0, y1 - pad)
-            x2 = min(w, x2 + pad)
-            y2 = min(h, y2 + pad)
-            
-            cropped_img = orig_img[y1:y2, x1:x2].copy()
-            cropped_mask = mask[y1:y2, x1:x2].copy()
-            
-            # Create RGBA image
-            rgba = cv2.cvtColor(cropped_img, cv2.COLOR_RGB2RGBA)
-            rgba[:, :, 3] = cropped_mask
-            
-            # Convert to base64
+        # Sprites keep their alpha, so JPEG requests fall back to PNG
+        encoding = negotiate_encoding(allow_alpha=True)
+        # cut from the working image; sprite bboxes reported in upload pixels
+        sprites = extract_sprites(image.rgb, to_working(seg_results, image))
+        sx, sy = image.scale
+        for info, _ in sprites:
+            x1, y1, x2, y2 = info["bbox"]
+            info["bbox"] = [round(x1 * sx), round(y1 * sy), round(x2 * sx), round(y2 * sy)]
+
+        if request.values.get("layout") == "atlas":
+            # One packed texture plus a coordinate map
+            atlas, frames = pack_atlas(sprites)
+            return image_response({
+                "success": True,
+                "frames": frames,
+                "atlas_width": atlas.shape[1],
+                "atlas_height": atlas.shape[0],
+                "count": len(frames)
+            }, {"atlas": Image.fromarray(atlas)}, encoding)
+
+        sprite_infos = []
+        sprite_images = {}
+        for info, rgba in sprites:
+            sprite = {k: info[k] for k in ("id", "label", "width", "height")}
             pil_img = Image.fromarray(rgba)
-            b64 = pil_to_base64(pil_img)
-            
-            sprites.append({
-                "id": i,
-                "label": label,
-                "image": b64,
-                "width": x2 - x1,
-                "height": y2 - y1
-            })
+            if encoding.mode == "json":
+                sprite["image"] = encoding.to_base64(pil_img)
+            else:
+                # binary / multipart: one body part per sprite
+                sprite_images[f"sprite_{info['id']}"] = pil_img
+            sprite_infos.append(sprite)
             
-        return jsonify({
+        return image_response({
             "success": True,
-            "sprites": sprites,
-            "count": len(sprites)
-        })
+            "sprites": sprite_infos,
+            "count": len(sprite_infos)
+        }, sprite_images, encoding)
         
     except Exception as e:
-        print(f"ERROR in target tagger: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("Target tagger failed")
         return jsonify({"error": str(e)}), 500
 
 
+# Load MODEL_WARMUP models in the background; everything else loads on first use.
+# Model worker processes re-import this module and must skip all of this.
+if not in_worker:
+    upload_store.start_gc()
+    model_registry.warm_up()
+    start_worker_pools()
+    noise_pools.start()
+
+
 if __name__ == "__main__":
     app.run(debug=True)
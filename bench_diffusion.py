@@ -0,0 +1,92 @@
+"""Benchmark: Stable Diffusion runtime profiles (RUNTIME_PROFILE).
+
+Usage: python bench_diffusion.py [image_path] [--profiles default,cpu-fast] [--runs N]
+Each profile runs in its own subprocess, so load time, seconds per image and
+peak RSS are measured independently. Extra options can be passed through
+the environment, e.g. SD_COMPILE=1 python bench_diffusion.py.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_worker(profile, image_path, runs):
+    """Benchmark one profile in this process and print a JSON result line."""
+    os.environ["RUNTIME_PROFILE"] = profile
+    os.environ.pop("DIFFUSION_CACHE_DIR", None)
+
+    from PIL import Image
+    from models.registry import model_registry
+    from models.sketch_diffusion import sketch_to_image, PROFILE
+
+    if image_path:
+        sketch = Image.open(image_path).convert("RGB")
+    else:
+        sketch = Image.new("RGB", (512, 512), (255, 255, 255))
+
+    start = time.perf_counter()
+    pipe = model_registry.get("sketch")
+    load_seconds = time.perf_counter() - start
+
+    # first call pays for lazy initialisation; not counted
+    sketch_to_image(sketch, seed=0)
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        # distinct seeds, so the result cache never answers
+        sketch_to_image(sketch, seed=i + 1)
+        times.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        "profile": profile,
+        "backend": "diffusers" if pipe is not None else "fallback",
+        "options": PROFILE,
+        "load_seconds": round(load_seconds, 2),
+        "seconds_per_image": round(sum(times) / len(times), 3),
+        "best_seconds": round(min(times), 3),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("image", nargs="?", help="sketch image (default: blank 512x512)")
+    parser.add_argument("--profiles", default="default,cpu-fast")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.image, args.runs)
+        return
+
+    results = []
+    for profile in args.profiles.split(","):
+        cmd = [sys.executable, os.path.abspath(__file__), "--worker", profile, "--runs", str(args.runs)]
+        if args.image:
+            cmd.append(args.image)
+        proc = subprocess.run(cmd, capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+        lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+        if proc.returncode != 0 or not lines:
+            print(f"{profile}: failed\n{proc.stderr[-2000:]}")
+            continue
+        results.append(json.loads(lines[-1]))
+
+    print(f"{'profile':<12}{'backend':<11}{'load s':>8}{'s/image':>10}{'best s':>9}{'peak RSS MB':>13}")
+    for r in results:
+        print(f"{r['profile']:<12}{r['backend']:<11}{r['load_seconds']:>8}"
+              f"{r['seconds_per_image']:>10}{r['best_seconds']:>9}{r['peak_rss_mb']:>13}")
+
+
+if __name__ == "__main__":
+    main()
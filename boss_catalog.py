@@ -0,0 +1,353 @@
+# boss_catalog.py
+"""Catalog of boss images with precomputed analysis.
+
+Every boss image gets a stable ID (a prefix of its content hash) when it is
+uploaded. A background worker then runs pose estimation, the object-detection
+fallback and segmentation once, and keeps the ready-to-send base64 payloads
+in memory. `/api/boss/start` and `/api/boss/analyze` only look entries up.
+
+Pose and detection run concurrently (models.detection.
+run_pose_or_detection). BOSS_SINGLE_PASS=1 runs the pose model alone and
+uses its person boxes when it finds no usable skeleton; detection then only
+runs for bosses without people, which saves compute when most bosses are
+people and the CPU has no room for two models at once.
+
+On disk the catalog lives next to the images:
+  boss_uploads/catalog.json        -> index of {id, filename, created}
+  boss_uploads/analysis/<id>.json  -> detections, segments, encoded overlay
+  boss_uploads/analysis/<id>.claim -> present while one process analyses <id>
+  boss_uploads/images/ab/cd/<sha256>.<ext>
+                                   -> the images, in a ContentStore without
+                                      retention (see storage.py)
+Images from before the store, or copied into boss_uploads/ by hand, are
+indexed where they lie; only uploads go into the store.
+
+Every server process keeps its own copy of the catalog. Writes to
+catalog.json are merged under a file lock, and a lookup that misses (or
+pick_random after the index changed) re-reads it, so an image uploaded
+through one process is found by the others; its analysis is then read from
+analysis/<id>.json once the process that queued it has written it. Only
+the process that creates analysis/<id>.claim analyses an image; the others
+wait for its result (and take over if the claim goes away without one).
+"""
+import base64
+import fcntl
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from storage import ContentStore
+
+log = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+SINGLE_PASS = os.environ.get("BOSS_SINGLE_PASS", "0") == "1"
+
+# seconds after which a claim on an analysis counts as abandoned
+CLAIM_TIMEOUT = 600.0
+
+PENDING = "pending"
+READY = "ready"
+FAILED = "failed"
+
+
+class BossCatalog:
+    def __init__(self, folder, encode, wait_timeout=120.0):
+        """
+        folder: directory holding the boss images
+        encode: callable turning a PIL image into a base64 string
+        wait_timeout: seconds a request may wait for a pending precompute
+        """
+        self.folder = folder
+        self.encode = encode
+        self.wait_timeout = wait_timeout
+        self.index_path = os.path.join(folder, "catalog.json")
+        self.analysis_dir = os.path.join(folder, "analysis")
+        os.makedirs(self.analysis_dir, exist_ok=True)
+        # pinned: boss images are never garbage collected
+        self.store = ContentStore(os.path.join(folder, "images"))
+
+        self._entries = {}
+        self._order = []
+        self._futures = {}
+        self._latest = None
+        self._index_mtime = None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="boss-catalog")
+        self._load()
+
+    # ---------- registration ----------
+
+    def _load(self):
+        """Load the index and analysis files; index any images dropped into the folder."""
+        for item in self._read_index():
+            if os.path.exists(os.path.join(self.folder, item["filename"])):
+                self._add_entry(item["id"], item["filename"], item["created"])
+
+        # Images dropped into the folder directly are registered where they lie
+        indexed = {e["filename"] for e in self._entries.values()}
+        for filename in sorted(os.listdir(self.folder)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS) or filename in indexed:
+                continue
+            path = os.path.join(self.folder, filename)
+            try:
+                created = os.path.getctime(path)
+                with open(path, "rb") as f:
+                    boss_id = self._make_id(f.read())
+            except OSError:
+                continue  # removed while we were listing
+            if boss_id not in self._entries:
+                self._add_entry(boss_id, filename, created)
+
+        self._save_index()
+        for boss_id in list(self._order):
+            if not self._load_analysis(boss_id):
+                self._schedule(boss_id)
+
+    @staticmethod
+    def _make_id(data):
+        return hashlib.sha256(data).hexdigest()[:16]
+
+    def _store_filename(self, key):
+        return os.path.relpath(self.store.path(key), self.folder)
+
+    def _add_entry(self, boss_id, filename, created):
+        self._entries[boss_id] = {
+            "id": boss_id,
+            "filename": filename,
+            "path": os.path.join(self.folder, filename),
+            "created": created,
+            "status": PENDING,
+        }
+        self._order.append(boss_id)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            self._index_mtime = os.stat(self.index_path).st_mtime_ns
+            return index
+        except (OSError, ValueError):
+            return []
+
+    def _merge_index(self, index):
+        """Add entries other processes wrote to the index. Returns the new IDs."""
+        with self._lock:
+            known = set(self._entries)
+        present = [item for item in index if item["id"] not in known
+                   and os.path.exists(os.path.join(self.folder, item["filename"]))]
+        added = []
+        with self._lock:
+            for item in present:
+                if item["id"] not in self._entries:
+                    self._add_entry(item["id"], item["filename"], item["created"])
+                    added.append(item["id"])
+        return added
+
+    def _refresh(self):
+        """Pick up entries registered by other processes if the index changed."""
+        try:
+            mtime = os.stat(self.index_path).st_mtime_ns
+        except OSError:
+            return
+        if mtime == self._index_mtime:
+            return
+        for boss_id in self._merge_index(self._read_index()):
+            self._load_analysis(boss_id)
+
+    def _save_index(self):
+        # other processes write the index too: merge their entries first
+        with open(f"{self.index_path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            added = self._merge_index(self._read_index())
+            self._write_index()
+        for boss_id in added:
+            self._load_analysis(boss_id)
+
+    def _write_index(self):
+        with self._lock:
+            index = [
+                {"id": e["id"], "filename": e["filename"], "created": e["created"]}
+                for e in (self._entries[i] for i in self._order)
+            ]
+        # per-process temp name: every server process loads (and may rewrite) the index
+        tmp = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp, self.index_path)
+        self._index_mtime = os.stat(self.index_path).st_mtime_ns
+
+    def register(self, data, ext=".png"):
+        """Store uploaded bytes and queue their analysis. Returns the boss ID."""
+        boss_id = self._make_id(data)
+        with self._lock:
+            self._latest = boss_id
+            if boss_id in self._entries:
+                return boss_id
+        # file writes happen outside the lock, so lookups never wait on them
+        filename = self._store_filename(self.store.put(data, ext))
+        with self._lock:
+            if boss_id in self._entries:
+                return boss_id  # registered by a concurrent upload
+            self._add_entry(boss_id, filename, time.time())
+        self._save_index()
+        self._schedule(boss_id)
+        return boss_id
+
+    # ---------- background analysis ----------
+
+    def _claim_path(self, boss_id):
+        return os.path.join(self.analysis_dir, f"{boss_id}.claim")
+
+    def _claim(self, boss_id):
+        """Take the analysis of `boss_id` for this process; False if another
+        process (or an earlier schedule here) already has it."""
+        path = self._claim_path(boss_id)
+        try:
+            if time.time() - os.path.getmtime(path) > CLAIM_TIMEOUT:
+                os.remove(path)  # left behind by a process that died
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            return False
+
+    def _schedule(self, boss_id):
+        """Queue the analysis unless another process runs it. Returns True if queued."""
+        if not self._claim(boss_id):
+            return False
+        future = self._executor.submit(self._precompute, boss_id)
+        with self._lock:
+            self._futures[boss_id] = future
+        return True
+
+    def _analysis_path(self, boss_id):
+        return os.path.join(self.analysis_dir, f"{boss_id}.json")
+
+    def _load_analysis(self, boss_id):
+        try:
+            with open(self._analysis_path(boss_id), "r", encoding="utf-8") as f:
+                analysis = json.load(f)
+            entry = self._entries[boss_id]
+            with open(entry["path"], "rb") as f:
+                data = f.read()
+        except (OSError, ValueError):
+            return False
+        if list(Image.open(io.BytesIO(data)).size) != analysis.get("image_size"):
+            # written when results were in downscaled coordinates: redo it
+            return False
+        entry["image_b64"] = base64.b64encode(data).decode("utf-8")
+        entry.update(analysis)
+        entry["status"] = READY
+        return True
+
+    def _precompute(self, boss_id):
+        entry = self._entries[boss_id]
+        path = entry["path"]
+        try:
+            from models.detection import run_pose_or_detection
+            from models.segmentation import run_segmentation
+            from models.image_io import ImageInput
+
+            # One decode shared by all three models
+            image = ImageInput(path=path)
+
+            # Pose (best for villains/persons), objects as the fallback
+            detections, mode, _ = run_pose_or_detection(image, speculative=not SINGLE_PASS)
+
+            segments, overlay_img = run_segmentation(image)
+
+            analysis = {
+                "detections": detections,
+                "mode": mode,
+                "segments": segments,
+                "overlay_b64": self.encode(overlay_img),
+                # detections and segments are in the stored image's pixels
+                "image_size": list(image.original_size),
+            }
+            tmp = f"{self._analysis_path(boss_id)}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(analysis, f)
+            os.replace(tmp, self._analysis_path(boss_id))
+
+            analysis["image_b64"] = base64.b64encode(image.data).decode("utf-8")
+
+            entry.update(analysis)
+            entry["status"] = READY
+            log.info("Boss %s ready (%d detections, mode: %s)", boss_id, len(detections), mode)
+        except Exception as e:
+            log.exception("Boss %s analysis failed", boss_id)
+            entry["error"] = str(e)
+            entry["status"] = FAILED
+        finally:
+            try:
+                os.remove(self._claim_path(boss_id))
+            except OSError:
+                pass
+
+    # ---------- lookups ----------
+
+    def _wait(self, boss_id):
+        future = self._futures.get(boss_id)
+        entry = self._entries[boss_id]
+        if future is not None:
+            future.result(timeout=self.wait_timeout)
+        elif entry["status"] == PENDING:
+            # claimed by another process: wait for its analysis file
+            deadline = time.monotonic() + self.wait_timeout
+            while not self._load_analysis(boss_id) and time.monotonic() < deadline:
+                if (not os.path.exists(self._claim_path(boss_id))
+                        and not self._load_analysis(boss_id) and self._schedule(boss_id)):
+                    # it gave up or died: analyse here
+                    self._futures[boss_id].result(timeout=max(0.0, deadline - time.monotonic()))
+                    break
+                time.sleep(0.5)
+        return entry
+
+    def get(self, boss_id):
+        """Return the entry for `boss_id`, waiting for its analysis if queued."""
+        if boss_id not in self._entries:
+            self._refresh()
+            if boss_id not in self._entries:
+                return None
+        return self._wait(boss_id)
+
+    def get_nowait(self, boss_id):
+        if boss_id not in self._entries:
+            self._refresh()
+        return self._entries.get(boss_id)
+
+    def latest_id(self):
+        self._refresh()
+        with self._lock:
+            if self._latest is not None:
+                return self._latest
+            return self._order[-1] if self._order else None
+
+    def pick_random(self):
+        """A random analysed entry, or the oldest pending one if none is ready."""
+        self._refresh()
+        with self._lock:
+            ready = [i for i in self._order if self._entries[i]["status"] == READY]
+            pending = [i for i in self._order if self._entries[i]["status"] == PENDING]
+        if ready:
+            return self._entries[random.choice(ready)]
+        if pending:
+            return self._wait(pending[0])
+        return None
+
+    def stats(self):
+        with self._lock:
+            statuses = [e["status"] for e in self._entries.values()]
+        return {s: statuses.count(s) for s in (PENDING, READY, FAILED)}
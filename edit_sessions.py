@@ -0,0 +1,169 @@
+# edit_sessions.py
+"""Server-side image state for the Object Removal Arena.
+
+/api/detect_objects?session=1 opens a session holding the decoded pixels
+and returns its handle. Edits are applied to that server copy and only the
+changed tiles (one per disjoint edited region, with their offsets) travel
+back to the browser. Each edit stores the before and after patches of
+those regions, which gives cheap undo/redo.
+
+Sessions expire after EDIT_SESSION_TTL seconds of inactivity. When the total
+memory of all sessions exceeds EDIT_SESSION_MEMORY_MB, the least recently
+used sessions are dropped first.
+
+Sessions live in the memory of the server process that opened them. With
+several processes (gunicorn workers) every request for a handle must reach
+that process, e.g. a load balancer with sticky sessions; elsewhere the
+handle is unknown (404).
+"""
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+from models.edit_engine import apply_edits, edit_regions
+
+SESSION_TTL = float(os.environ.get("EDIT_SESSION_TTL", "900"))
+SESSION_MEMORY_MB = float(os.environ.get("EDIT_SESSION_MEMORY_MB", "512"))
+MAX_UNDO = int(os.environ.get("EDIT_SESSION_MAX_UNDO", "20"))
+
+
+def _crop(pixels, rect):
+    x1, y1, x2, y2 = rect
+    return pixels[y1:y2, x1:x2]
+
+
+def scale_actions(actions, scale):
+    """Actions with their bboxes divided by `scale` (x, y), e.g. mapped from
+    uploaded-image pixels onto a downscaled working image."""
+    sx, sy = scale
+    if sx == 1 and sy == 1:
+        return actions
+    return [dict(act, bbox=[int(round(act["bbox"][0] / sx)), int(round(act["bbox"][1] / sy)),
+                            int(round(act["bbox"][2] / sx)), int(round(act["bbox"][3] / sy))])
+            for act in actions]
+
+
+class EditSession:
+    def __init__(self, handle, pixels, scale=(1.0, 1.0)):
+        self.handle = handle
+        self.pixels = pixels
+        self.scale = scale
+        self.version = 0
+        self.undo_stack = []  # per edit: [(rect, before_patch, after_patch)]
+        self.redo_stack = []
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        patches = sum(b.nbytes + a.nbytes
+                      for edit in self.undo_stack + self.redo_stack for _, b, a in edit)
+        return self.pixels.nbytes + patches
+
+    def apply(self, actions):
+        """Apply actions (bboxes in uploaded-image pixels); returns the
+        changed rectangles of the session image, one per disjoint region."""
+        actions = scale_actions(actions, self.scale)
+        regions = edit_regions(self.pixels.shape, actions)
+        if not regions:
+            return []
+        befores = [_crop(self.pixels, r).copy() for r in regions]
+        if apply_edits(self.pixels, actions) is None:
+            return []
+
+        patches = []
+        for rect, before in zip(regions, befores):
+            after = _crop(self.pixels, rect)
+            if not np.array_equal(before, after):
+                patches.append((rect, before, after.copy()))
+        if not patches:
+            return []
+        self.undo_stack.append(patches)
+        del self.undo_stack[:-MAX_UNDO]
+        self.redo_stack.clear()
+        self.version += 1
+        return [rect for rect, _, _ in patches]
+
+    def undo(self):
+        if not self.undo_stack:
+            return []
+        patches = self.undo_stack.pop()
+        for rect, before, _ in patches:
+            _crop(self.pixels, rect)[:] = before
+        self.redo_stack.append(patches)
+        self.version += 1
+        return [rect for rect, _, _ in patches]
+
+    def redo(self):
+        if not self.redo_stack:
+            return []
+        patches = self.redo_stack.pop()
+        for rect, _, after in patches:
+            _crop(self.pixels, rect)[:] = after
+        self.undo_stack.append(patches)
+        self.version += 1
+        return [rect for rect, _, _ in patches]
+
+
+class EditSessionStore:
+    def __init__(self, ttl=SESSION_TTL, memory_mb=SESSION_MEMORY_MB):
+        self.ttl = ttl
+        self.max_bytes = int(memory_mb * 1024 * 1024)
+        self._sessions = OrderedDict()  # least recently used first
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def create(self, pixels, scale=(1.0, 1.0)):
+        """
+        Start a session on a writable HxWx3 array. `scale` maps its pixels
+        to those of the uploaded image (ImageInput.scale). Returns its handle.
+        """
+        handle = uuid.uuid4().hex
+        with self._lock:
+            self._sessions[handle] = EditSession(handle, pixels, scale)
+            self._evict(keep=handle)
+        return handle
+
+    def get(self, handle):
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(handle)
+            if session is not None:
+                session.last_used = time.time()
+                self._sessions.move_to_end(handle)
+            return session
+
+    def close(self, handle):
+        with self._lock:
+            return self._sessions.pop(handle, None) is not None
+
+    def _evict(self, keep=None):
+        now = time.time()
+        for handle in [h for h, s in self._sessions.items() if now - s.last_used > self.ttl]:
+            del self._sessions[handle]
+            self.evictions += 1
+
+        total = sum(s.nbytes for s in self._sessions.values())
+        for handle in list(self._sessions):
+            if total <= self.max_bytes:
+                break
+            if handle == keep:
+                continue
+            total -= self._sessions.pop(handle).nbytes
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "memory_mb": round(sum(s.nbytes for s in self._sessions.values()) / 2**20, 1),
+                "max_memory_mb": round(self.max_bytes / 2**20, 1),
+                "evictions": self.evictions,
+            }
+
+
+edit_sessions = EditSessionStore()
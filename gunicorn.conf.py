@@ -0,0 +1,28 @@
+# gunicorn.conf.py
+"""Gunicorn settings: gunicorn -c gunicorn.conf.py app:app
+
+With PRELOAD_MODELS (e.g. "detect,pose,seg,sketch" or "all") the master
+loads and warms those models before forking, and the workers share the
+weights instead of each loading a copy (see models/preload.py). The app
+itself is still imported per worker, after the fork, so its background
+threads start in the process that uses them.
+
+WEB_CONCURRENCY, GUNICORN_THREADS, GUNICORN_TIMEOUT and BIND override the
+defaults below.
+"""
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+# diffusion requests can run for a while on CPU
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "300"))
+
+
+def on_starting(server):
+    """Runs once in the master, before the first worker is forked."""
+    from models.preload import PRELOAD_MODELS, preload_models
+    if PRELOAD_MODELS:
+        import instrumentation
+        instrumentation.setup_logging()
+        preload_models()
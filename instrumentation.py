@@ -0,0 +1,257 @@
+# instrumentation.py
+"""Stage timers, Prometheus metrics and logging setup.
+
+  with stage("decode"): ...      time one step of the current request; the
+                                 totals go out in the Server-Timing header
+                                 and into stage_duration_seconds
+  with model_timer("detect"): .. time one forward pass (any thread) into
+                                 model_inference_seconds
+  gauge(name, help, fn)          a value (or {labels: value}) read at scrape
+  render_metrics()               Prometheus text exposition of everything
+
+init_app(app) adds the per-request hooks (http_request_duration_seconds and
+Server-Timing). setup_logging() routes all logging through a QueueHandler,
+so request threads only enqueue records; a QueueListener thread formats and
+writes them. LOG_LEVEL sets the level, LOG_FORMAT is "json" (default) or
+"text".
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for n, v in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted(self._series.items())
+        for labelvalues, series in items:
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-2] + [series[-1]]):
+                labels = _format_labels(self.labelnames + ("le",), labelvalues + (str(bound),))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {series[-2]:.6f}")
+            lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+class Gauge:
+    """Read at scrape time: fn() returns a number or {label values: number}."""
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception as e:
+            log.warning("gauge %s failed: %s", self.name, e)
+            return lines
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        for labelvalues, v in sorted(values):
+            if not isinstance(labelvalues, tuple):
+                labelvalues = (labelvalues,)
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}{labels} {_format_value(v)}")
+        return lines
+
+
+_metrics = []
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, help, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name, help, fn, labelnames=()):
+    metric = Gauge(name, help, fn, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def render_metrics():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+request_latency = histogram(
+    "http_request_duration_seconds", "Request latency by endpoint",
+    ("endpoint", "method", "status"))
+stage_latency = histogram(
+    "stage_duration_seconds", "Time spent in each request stage",
+    ("endpoint", "stage"))
+model_latency = histogram(
+    "model_inference_seconds", "Forward-pass latency by model (one call, possibly batched)",
+    ("model",))
+
+
+def _endpoint():
+    return request.endpoint or "unknown"
+
+
+def record_stage(name, seconds):
+    """Add `seconds` to stage `name` of the current request (no-op outside requests)."""
+    if has_request_context():
+        timings = g.setdefault("stage_timings", {})
+        timings[name] = timings.get(name, 0.0) + seconds
+        stage_latency.observe(seconds, _endpoint(), name)
+
+
+@contextmanager
+def stage(name):
+    """Time a step of the current request (a no-op outside requests)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
+
+
+@contextmanager
+def model_timer(model):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        model_latency.observe(time.perf_counter() - start, model)
+
+
+def init_app(app):
+    @app.before_request
+    def _start_timer():
+        g.request_start = time.perf_counter()
+        g.stage_timings = {}
+
+    @app.after_request
+    def _finish_timer(response):
+        start = g.get("request_start")
+        if start is None:
+            return response
+        total = time.perf_counter() - start
+        request_latency.observe(total, _endpoint(), request.method, str(response.status_code))
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in g.stage_timings.items()]
+        entries.append(f"total;dur={total * 1000:.1f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+        return response
+
+
+# ---------- logging ----------
+
+log = logging.getLogger(__name__)
+
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; `extra=` fields are included as keys."""
+
+    def format(self, record):
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+_listener = None
+
+
+def setup_logging(level=None, fmt=None):
+    """Send all logging through a background QueueListener (idempotent)."""
+    global _listener
+    if _listener is not None:
+        return
+    level = level or os.environ.get("LOG_LEVEL", "INFO")
+    fmt = fmt or os.environ.get("LOG_FORMAT", "json")
+
+    handler = logging.StreamHandler()
+    if fmt == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level.upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def _restart_listener():
+    # a forked child (e.g. a pre-fork server worker) inherits the handler
+    # but not the listener thread; records still queued belong to the parent
+    if _listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = log_queue
+    _listener.queue = log_queue
+    _listener._thread = None
+    _listener.start()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_listener)
@@ -8,4 +8,15 @@ __all__ = [
     "segmentation",
     "sketch_diffusion",
     "gan_playground",
+    "result_cache",
+    "batching",
+    "image_io",
+    "registry",
+    "edit_engine",
+    "mask_encoding",
+    "sprites",
+    "diffusion_jobs",
+    "diffusion_pools",
+    "workers",
+    "preload",
 ]
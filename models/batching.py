@@ -0,0 +1,141 @@
+# models/batching.py
+"""Dynamic micro-batching in front of the YOLO models.
+
+Concurrent Flask requests submit single images; a scheduler thread per model
+collects them for up to `window_ms` (or until `max_batch` are waiting), runs
+one batched predict and hands each caller its own result.
+
+Configure with YOLO_BATCH_WINDOW_MS and YOLO_MAX_BATCH. A window of 0 or a
+max batch of 1 disables batching and predicts in the calling thread.
+
+When predict_batch is a WorkerPool (models/workers.py) its `concurrency`
+scheduler threads collect batches, so every worker process stays busy.
+"""
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+BATCH_WINDOW_MS = float(os.environ.get("YOLO_BATCH_WINDOW_MS", "5"))
+MAX_BATCH = int(os.environ.get("YOLO_MAX_BATCH", "8"))
+
+# name -> BatchScheduler, for stats reporting
+schedulers = {}
+
+
+class BatchScheduler:
+    def __init__(self, name, predict_batch, max_batch=MAX_BATCH, window_ms=BATCH_WINDOW_MS):
+        """
+        name: label used in stats
+        predict_batch: callable taking a list of inputs, returning a list of
+                       results in the same order
+        """
+        self.name = name
+        self.predict_batch = predict_batch
+        self.max_batch = max(1, max_batch)
+        self.window = max(0.0, window_ms) / 1000.0
+        self.concurrency = max(1, getattr(predict_batch, "concurrency", 1))
+        self._queue = queue.Queue()
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.items = 0
+        self.cancelled = 0
+        schedulers[name] = self
+
+    @property
+    def enabled(self):
+        return self.window > 0 and self.max_batch > 1
+
+    def _ensure_thread(self):
+        if self._threads:
+            return
+        with self._start_lock:
+            if not self._threads:
+                for i in range(self.concurrency):
+                    thread = threading.Thread(
+                        target=self._run, name=f"batch-{self.name}-{i}", daemon=True
+                    )
+                    thread.start()
+                    self._threads.append(thread)
+
+    def submit(self, item):
+        """Queue one input. Returns a Future; cancelling it before its batch
+        starts drops the input from the batch."""
+        future = Future()
+        if not self.enabled:
+            if future.set_running_or_notify_cancel():
+                self._record(1)
+                try:
+                    future.set_result(self.predict_batch([item])[0])
+                except Exception as e:
+                    future.set_exception(e)
+            return future
+
+        self._ensure_thread()
+        self._queue.put((item, future))
+        return future
+
+    def predict(self, item):
+        """Blocking convenience wrapper around submit()."""
+        return self.submit(item).result()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            live = [(item, fut) for item, fut in batch if fut.set_running_or_notify_cancel()]
+            with self._stats_lock:
+                self.cancelled += len(batch) - len(live)
+            if not live:
+                continue
+
+            self._record(len(live))
+            try:
+                results = self.predict_batch([item for item, _ in live])
+            except Exception as e:
+                for _, fut in live:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), res in zip(live, results):
+                fut.set_result(res)
+
+    def _record(self, size):
+        with self._stats_lock:
+            self.batch_sizes[size] += 1
+            self.items += size
+
+    def stats(self):
+        with self._stats_lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                "enabled": self.enabled,
+                "window_ms": self.window * 1000.0,
+                "max_batch": self.max_batch,
+                "concurrency": self.concurrency,
+                "queue_depth": self._queue.qsize(),
+                "batches": batches,
+                "items": self.items,
+                "cancelled": self.cancelled,
+                "mean_batch_size": round(self.items / batches, 2) if batches else 0.0,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            }
+
+
+def scheduler_stats():
+    return {name: s.stats() for name, s in schedulers.items()}
@@ -1,47 +1,67 @@
 # models/detection.py
 from PIL import Image, ImageDraw
+import logging
 import os
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+
+from instrumentation import stage, model_timer
+from models.result_cache import result_cache
+from models.batching import BatchScheduler
+from models.image_io import as_image_input
+from models.registry import model_registry
+from models.workers import predictor, use_workers
+
+log = logging.getLogger(__name__)
 
 try:
+    import ultralytics
     from ultralytics import YOLO
     _HAS_ULTRALYTICS = True
+    _ULTRALYTICS_VERSION = ultralytics.__version__
 except Exception:
     YOLO = None
     _HAS_ULTRALYTICS = False
-    print(f"DEBUG: Could not import ultralytics: {Exception}")
+    _ULTRALYTICS_VERSION = None
+    log.warning("Could not import ultralytics, object detection disabled")
 
+DETECT_WEIGHTS = "yolov8n.pt"
+POSE_WEIGHTS = "yolov8n-pose.pt"
 
-_model = None
-if _HAS_ULTRALYTICS:
-    try:
-        # attempt to load the nano model (this will download weights on first run)
-        _model = YOLO("yolov8n.pt")
-    except Exception as e:
-        print(f"DEBUG: Failed to load YOLO model: {e}")
-        _model = None
+def _warm_yolo(model):
+    # the first predict builds the predictor and fuses conv+bn layers;
+    # done before a fork, the fused weights are shared too
+    model(np.zeros((64, 64, 3), dtype=np.uint8), verbose=False)
 
 
-def run_object_detection(image_path):
-    """
-    Returns:
-      detections: list of dicts {bbox:[x1,y1,x2,y2], label:str, score:float}
-      original_img: PIL.Image WITHOUT drawn boxes (clean)
+if _HAS_ULTRALYTICS and not use_workers():
+    # loaded on first use or at warm-up (weights download on first run);
+    # with MODEL_WORKERS each worker process loads its own copy instead
+    model_registry.register("detect", lambda: YOLO(DETECT_WEIGHTS), warm=_warm_yolo)
+    model_registry.register("pose", lambda: YOLO(POSE_WEIGHTS), warm=_warm_yolo)
 
-    If Ultralytics/YOLO is not available, returns an empty detection list
-    and the original image (so the app remains functional on laptops).
-    """
-    img = Image.open(image_path).convert("RGB")
 
-    if _model is None:
-        # fallback: no detections
-        return [], img
+def _model_ready(name):
+    return use_workers() or model_registry.get(name) is not None
 
-    try:
-        results = _model(image_path)[0]
-    except Exception as e:
-        print(f"DEBUG: Error during detection inference: {e}")
-        return [], img
 
+def _predict_with(name, postprocess):
+    """
+    predict_batch for a YOLO model: one forward pass over the batch, then
+    `postprocess` turns each Results into plain lists and dicts, which is
+    what a worker process can send back.
+    """
+    def predict(sources):
+        model = model_registry.get(name)
+        if model is None:
+            raise RuntimeError(f"{name} model is not available")
+        with model_timer(name):
+            results = model(sources, verbose=False)
+        return [postprocess(r) for r in results]
+    return predict
+
+
+def _detections_from(results):
     detections = []
     names = getattr(results, 'names', {})
     for box in getattr(results, 'boxes', []):
@@ -59,52 +79,239 @@ def run_object_detection(image_path):
         except Exception:
             # ignore single-box problems
             continue
+    return detections
+
+
+def _poses_from(results):
+    pose_results = []
+    if results.keypoints is not None:
+        # Iterate over each detected person
+        for i, kps in enumerate(results.keypoints.data):
+            # kps is a tensor of shape (17, 3) -> [x, y, conf]
+            # Box is in results.boxes[i]
+            box = results.boxes[i].xyxy[0].tolist()
+
+            pose_results.append({
+                "keypoints": kps.tolist(), # Convert tensor to list
+                "bbox": [int(b) for b in box],
+                "label": "person",
+                "score": round(float(results.boxes[i].conf[0].item()), 3)
+            })
+    return pose_results
+
+
+def _rescale(results, scale):
+    """
+    Map boxes, keypoints and polygons by the factors `scale`, e.g. from
+    model-input pixels onto the uploaded image (ImageInput.model_input).
+    """
+    sx, sy = scale
+    if sx == 1 and sy == 1:
+        return results
+    mapped = []
+    for res in results:
+        res = dict(res)
+        x1, y1, x2, y2 = res["bbox"]
+        res["bbox"] = [int(round(x1 * sx)), int(round(y1 * sy)), int(round(x2 * sx)), int(round(y2 * sy))]
+        if res.get("keypoints"):
+            kps = np.asarray(res["keypoints"], dtype=np.float64)
+            kps[:, :2] *= (sx, sy)
+            res["keypoints"] = kps.tolist()
+        if res.get("mask"):
+            res["mask"] = (np.asarray(res["mask"], dtype=np.float64) * (sx, sy)).tolist()
+        mapped.append(res)
+    return mapped
+
+
+def to_working(results, inp):
+    """Results (in uploaded-image pixels) mapped onto inp's working image,
+    for drawing on or cropping from it."""
+    sx, sy = inp.scale
+    return _rescale(results, (1 / sx, 1 / sy))
+
+
+def _cache_key(inp, weights):
+    # results depend on the pixels the model saw, so the size limits are part of the key
+    return result_cache.make_key(inp.digest, f"{weights}@{inp.geometry}", _ULTRALYTICS_VERSION)
+
+
+def _infer(batcher, inp):
+    """Run `batcher`'s model on the downscaled model input; results in uploaded-image coordinates."""
+    pixels, scale = inp.model_input()
+    with stage("inference"):
+        return _rescale(batcher.predict(pixels), scale)
+
+
+predict_detect = _predict_with("detect", _detections_from)
+predict_pose = _predict_with("pose", _poses_from)
+
+# Concurrent requests share batched forward passes, see models/batching.py;
+# with MODEL_WORKERS the batches run in worker processes (models/workers.py)
+_detect_batcher = BatchScheduler(
+    "detect", predictor("detect", "models.detection:predict_detect", predict_detect))
+
+
+def run_object_detection(image_source):
+    """
+    image_source: path, encoded bytes, PIL image, RGB array or ImageInput
+    (see models/image_io.py); it is decoded once and shared with YOLO.
+
+    Returns:
+      detections: list of dicts {bbox:[x1,y1,x2,y2], label:str, score:float}
+                  in the uploaded image's pixels
+      original_img: PIL.Image WITHOUT drawn boxes (clean), the working image
+
+    If Ultralytics/YOLO is not available, returns an empty detection list
+    and the original image (so the app remains functional on laptops).
+    Results are cached by image content, see models/result_cache.py.
+    """
+    inp = as_image_input(image_source)
+    img = inp.pil
+
+    if not _HAS_ULTRALYTICS:
+        # fallback: no detections
+        return [], img
+
+    cache_key = _cache_key(inp, DETECT_WEIGHTS)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached, img
+
+    if not _model_ready("detect"):
+        return [], img
+
+    try:
+        detections = _infer(_detect_batcher, inp)
+    except Exception as e:
+        log.error("Detection inference failed: %s", e)
+        return [], img
+
+    result_cache.put(cache_key, detections)
 
     # Return CLEAN image without boxes drawn
     return detections, img
 
-_pose_model = None
+_pose_batcher = BatchScheduler(
+    "pose", predictor("pose", "models.detection:predict_pose", predict_pose))
 
-def run_pose_estimation(image_path):
+def run_pose_estimation(image_source):
     """
     Runs Pose Estimation (Skeleton Tracking) on the image.
+    Accepts the same image sources as run_object_detection.
     Returns:
       keypoints_list: List of dicts, each containing 'keypoints' (17x3 array) and 'bbox'.
       original_img: PIL Image
     """
-    global _pose_model
-    img = Image.open(image_path).convert("RGB")
+    inp = as_image_input(image_source)
+    img = inp.pil
     
     if not _HAS_ULTRALYTICS:
         return [], img
+
+    cache_key = _cache_key(inp, POSE_WEIGHTS)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return cached, img
         
-    if _pose_model is None:
-        try:
-            print("DEBUG: Loading YOLOv8-Pose model...")
-            _pose_model = YOLO("yolov8n-pose.pt")
-        except Exception as e:
-            print(f"DEBUG: Failed to load Pose model: {e}")
-            return [], img
+    if not _model_ready("pose"):
+        return [], img
             
     try:
-        results = _pose_model(image_path)[0]
+        pose_results = _infer(_pose_batcher, inp)
     except Exception as e:
-        print(f"DEBUG: Error during pose inference: {e}")
+        log.error("Pose inference failed: %s", e)
         return [], img
-        
-    pose_results = []
-    
-    if results.keypoints is not None:
-        # Iterate over each detected person
-        for i, kps in enumerate(results.keypoints.data):
-            # kps is a tensor of shape (17, 3) -> [x, y, conf]
-            # Box is in results.boxes[i]
-            box = results.boxes[i].xyxy[0].tolist()
-            
-            pose_results.append({
-                "keypoints": kps.tolist(), # Convert tensor to list
-                "bbox": [int(b) for b in box],
-                "label": "person"
-            })
+
+    result_cache.put(cache_key, pose_results)
             
     return pose_results, img
+
+
+# Runs speculative predictions when batching is off, where BatchScheduler.
+# submit would predict in the calling thread and pose and detection would
+# run back to back
+_speculative_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="speculative")
+
+# a pose result is a usable skeleton with this many keypoints above POSE_KEYPOINT_CONF
+POSE_MIN_KEYPOINTS = 5
+POSE_KEYPOINT_CONF = 0.5
+
+
+def _submit_cached(name, batcher, inp, weights):
+    """
+    (future, scale) for the model's result on `inp`. The future is already
+    resolved on a cache hit (or when the model is unavailable), else it is
+    the batcher's (or the speculative executor's when batching is off) and
+    its result still needs _rescale(result, scale). The result is cached
+    when it arrives, even if the caller no longer waits.
+    """
+    key = _cache_key(inp, weights)
+    cached = result_cache.get(key)
+    if cached is not None or not _model_ready(name):
+        future = Future()
+        future.set_result(cached if cached is not None else [])
+        return future, (1, 1)
+
+    pixels, scale = inp.model_input()
+
+    def store(f):
+        if not f.cancelled() and f.exception() is None:
+            result_cache.put(key, _rescale(f.result(), scale))
+
+    if batcher.enabled:
+        future = batcher.submit(pixels)
+    else:
+        future = _speculative_executor.submit(batcher.predict, pixels)
+    future.add_done_callback(store)
+    return future, scale
+
+
+def _result_or_empty(submitted, what):
+    future, scale = submitted
+    try:
+        return _rescale(future.result(), scale)
+    except Exception as e:
+        log.error("%s inference failed: %s", what, e)
+        return []
+
+
+def _has_skeleton(pose):
+    visible = sum(1 for kp in pose["keypoints"] if len(kp) < 3 or kp[2] >= POSE_KEYPOINT_CONF)
+    return visible >= POSE_MIN_KEYPOINTS
+
+
+def run_pose_or_detection(image_source, speculative=True):
+    """
+    Skeletons when the pose model finds people, object boxes otherwise.
+    Returns (detections, mode, original_img) with mode "pose" or "object".
+
+    speculative: run both models at once on the same decoded pixels, so
+    the worst case costs one inference of latency instead of two in a
+    row. If the pose result is used, detection is cancelled when it has
+    not started yet, and its result is cached when it has.
+    speculative=False is a single pass of the pose model: people with a
+    usable skeleton give "pose", people it only boxed are returned as
+    "object" boxes, and detection only runs when it found nobody at all.
+    """
+    inp = as_image_input(image_source)
+    img = inp.pil
+
+    if not _HAS_ULTRALYTICS:
+        return [], "object", img
+
+    poses = _submit_cached("pose", _pose_batcher, inp, POSE_WEIGHTS)
+    objects = _submit_cached("detect", _detect_batcher, inp, DETECT_WEIGHTS) if speculative else None
+
+    pose_results = _result_or_empty(poses, "Pose")
+    if objects is None and pose_results and not any(_has_skeleton(p) for p in pose_results):
+        boxes = [{"bbox": p["bbox"], "label": "person", "score": p.get("score", 0.0)}
+                 for p in pose_results]
+        return boxes, "object", img
+    if pose_results:
+        if objects is not None:
+            objects[0].cancel()
+        return pose_results, "pose", img
+
+    if objects is None:
+        objects = _submit_cached("detect", _detect_batcher, inp, DETECT_WEIGHTS)
+    return _result_or_empty(objects, "Detection"), "object", img
@@ -0,0 +1,293 @@
+# models/diffusion_jobs.py
+"""Bounded job queue for Stable Diffusion work.
+
+Diffusion calls no longer run inside whichever Flask thread received the
+request. They are queued as jobs and executed by a fixed pool of worker
+threads, so a handful of players cannot starve the detection endpoints.
+
+- jobs are served by priority (HIGH, NORMAL, LOW), FIFO within a priority
+- submit() raises QueueFull once DIFFUSION_QUEUE_LIMIT jobs are waiting
+- queued jobs with identical generation parameters are run as one batched
+  pipeline call (up to DIFFUSION_MAX_BATCH)
+- queue-wait and run-time metrics are kept per queue
+- jobs submitted with track=True (the async API) stay available to get()
+  and cancel() for RESULT_TTL seconds after they finish, at most
+  DIFFUSION_MAX_JOBS of them; callers waiting on their Job keep nothing in
+  the table. A finished job drops its input image.
+
+The queue lives in the process that accepted the job, so with several
+server processes (gunicorn workers) /api/jobs/<id> must reach that same
+process: route by job ID or client (sticky sessions), or poll a single
+process.
+
+Configuration: DIFFUSION_WORKERS, DIFFUSION_QUEUE_LIMIT, DIFFUSION_MAX_BATCH,
+DIFFUSION_MAX_JOBS, DIFFUSION_RESULT_TTL.
+"""
+import itertools
+import os
+import threading
+import time
+import uuid
+
+from models.image_io import as_image_input
+
+DIFFUSION_WORKERS = int(os.environ.get("DIFFUSION_WORKERS", "1"))
+QUEUE_LIMIT = int(os.environ.get("DIFFUSION_QUEUE_LIMIT", "16"))
+MAX_BATCH = int(os.environ.get("DIFFUSION_MAX_BATCH", "4"))
+# finished jobs are kept this long for /api/jobs/<id>/result
+RESULT_TTL = float(os.environ.get("DIFFUSION_RESULT_TTL", "600"))
+# tracked jobs kept at most, oldest finished dropped first
+MAX_JOBS = int(os.environ.get("DIFFUSION_MAX_JOBS", "256"))
+
+HIGH, NORMAL, LOW = 0, 1, 2
+PRIORITIES = {"high": HIGH, "normal": NORMAL, "low": LOW}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class QueueFull(Exception):
+    """The diffusion queue is at its limit; the caller should back off."""
+
+
+class Job:
+    def __init__(self, source, params, priority, seq, meta=None):
+        self.id = uuid.uuid4().hex
+        self.source = source
+        self.params = params
+        self.meta = meta or {}
+        self.priority = priority
+        self.seq = seq
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    @property
+    def batch_key(self):
+        """Jobs with equal keys can share one pipeline call (seeds may differ)."""
+        if self.params.get("on_step") is not None:
+            return None
+        return tuple(sorted((k, v) for k, v in self.params.items() if k != "seed"))
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the job finishes; returns the result image."""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Job {self.id} did not finish in time")
+        if self.status != DONE:
+            raise RuntimeError(self.error or f"Job {self.id} {self.status}")
+        return self.result
+
+    def info(self):
+        now = time.time()
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "priority": self.priority,
+            "queue_wait": round((self.started or now) - self.submitted, 3),
+            "run_time": round((self.finished or now) - self.started, 3) if self.started else None,
+            "error": self.error,
+        }
+
+
+class _Timing:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 3) if self.count else 0.0,
+            "max": round(self.max, 3),
+        }
+
+
+class DiffusionJobQueue:
+    def __init__(self, workers=DIFFUSION_WORKERS, limit=QUEUE_LIMIT, max_batch=MAX_BATCH,
+                 max_jobs=MAX_JOBS):
+        self.workers = max(1, workers)
+        self.limit = limit
+        self.max_batch = max(1, max_batch)
+        self.max_jobs = max_jobs
+        self._pending = []
+        self._jobs = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self.queue_wait = _Timing()
+        self.run_time = _Timing()
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.batches = 0
+        self.running = 0
+
+    def _ensure_workers(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name=f"diffusion-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, source, priority=NORMAL, meta=None, track=False, **params):
+        """
+        Queue a sketch_to_image call. `params` are its keyword arguments;
+        `meta` is free-form caller data kept on the job; `track` keeps the
+        job for get()/cancel() by ID.
+        Returns the Job; raises QueueFull when the queue is at its limit.
+        """
+        job = Job(as_image_input(source), params, priority, next(self._seq), meta)
+        with self._cond:
+            self._expire()
+            if len(self._pending) >= self.limit:
+                self.rejected += 1
+                raise QueueFull(f"Diffusion queue is full ({self.limit} jobs waiting)")
+            self._pending.append(job)
+            if track:
+                self._jobs[job.id] = job
+            self._ensure_workers()
+            self._cond.notify()
+        return job
+
+    def run(self, source, priority=NORMAL, timeout=None, **params):
+        """Submit and wait: the synchronous path used by the blocking endpoints."""
+        return self.submit(source, priority=priority, **params).wait(timeout)
+
+    def idle(self):
+        """True when no job is waiting or running."""
+        with self._cond:
+            return not self._pending and self.running == 0
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        """Drop a job that has not started yet. Returns True if it was removed."""
+        return self.cancel_job(self.get(job_id))
+
+    def cancel_job(self, job):
+        """cancel() for a Job object."""
+        with self._cond:
+            if job is None or job.status != QUEUED:
+                return False
+            self._pending.remove(job)
+            job.status = CANCELLED
+            job.finished = time.time()
+            job.source = None
+            job._done.set()
+            return True
+
+    def _expire(self):
+        """Drop tracked jobs finished more than RESULT_TTL ago, and the
+        oldest finished ones while there are more than max_jobs."""
+        now = time.time()
+        finished = [j for j in self._jobs.values() if j.finished is not None]
+        excess = len(self._jobs) - self.max_jobs
+        for job in sorted(finished, key=lambda j: j.finished):
+            if now - job.finished <= RESULT_TTL and excess <= 0:
+                break
+            del self._jobs[job.id]
+            excess -= 1
+
+    def _take_batch(self):
+        """Pop the most urgent job plus queued jobs with the same parameters."""
+        first = min(self._pending, key=lambda j: (j.priority, j.seq))
+        self._pending.remove(first)
+        batch = [first]
+        key = first.batch_key
+        if key is not None:
+            for job in sorted(self._pending, key=lambda j: (j.priority, j.seq)):
+                if len(batch) >= self.max_batch:
+                    break
+                if job.batch_key == key:
+                    self._pending.remove(job)
+                    batch.append(job)
+        return batch
+
+    def _worker(self):
+        from models.sketch_diffusion import GenerationCancelled, sketch_to_images
+
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                batch = self._take_batch()
+                now = time.time()
+                for job in batch:
+                    job.status = RUNNING
+                    job.started = now
+                    self.queue_wait.add(now - job.submitted)
+                self.running += len(batch)
+                self.batches += 1
+
+            start = time.perf_counter()
+            try:
+                params = {k: v for k, v in batch[0].params.items() if k != "seed"}
+                results = sketch_to_images([job.source for job in batch],
+                                           seeds=[job.params.get("seed") for job in batch],
+                                           **params)
+                status, error = DONE, None
+            except GenerationCancelled:
+                # a streaming client went away (its on_step raised)
+                results = [None] * len(batch)
+                status, error = CANCELLED, None
+            except Exception as e:
+                results = [None] * len(batch)
+                status, error = FAILED, str(e)
+            elapsed = time.perf_counter() - start
+
+            with self._cond:
+                self.running -= len(batch)
+                self.run_time.add(elapsed)
+                now = time.time()
+                for job, result in zip(batch, results):
+                    job.finished = now
+                    job.status = status
+                    if status == DONE:
+                        job.result = result
+                        self.completed += 1
+                    elif status == FAILED:
+                        job.error = error
+                        self.failed += 1
+                    job.source = None
+                    job._done.set()
+                self._expire()
+
+    def stats(self):
+        with self._cond:
+            by_priority = {name: sum(1 for j in self._pending if j.priority == p)
+                           for name, p in PRIORITIES.items()}
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self._pending),
+                "queue_depth_by_priority": by_priority,
+                "queue_limit": self.limit,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "queue_wait_seconds": self.queue_wait.summary(),
+                "run_seconds": self.run_time.summary(),
+            }
+
+
+diffusion_jobs = DiffusionJobQueue()
@@ -0,0 +1,159 @@
+# models/diffusion_pools.py
+"""Pre-generated image pools for fixed-prompt diffusion calls.
+
+The Noise Invasion endpoints use constant prompts, so their images can be
+made ahead of time. Each pool keeps up to `size` finished images in memory.
+A background thread tops the pools up with LOW priority jobs, and only
+while the diffusion queue is otherwise idle, so refills never delay player
+requests that are already waiting. take() serves instantly from a pool and
+returns None when it is empty; the caller then generates synchronously.
+
+Refills never load the diffusion model by themselves: they start once it is
+loaded, or once a pool has been used and the model fits in the memory budget
+(MODEL_MEMORY_BUDGET_MB) next to the models already loaded, so idle
+processes keep lazy loading and the pools do not push YOLO out. Without the
+diffusion model (no diffusers) the pools stay empty: the stylizer fallback
+is cheap enough to run per request.
+
+Configuration: NOISE_POOL_SIZE (images per pool, 0 disables the pools).
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+from models.diffusion_jobs import diffusion_jobs, LOW, QueueFull
+from models.registry import model_registry
+
+log = logging.getLogger(__name__)
+
+POOL_SIZE = int(os.environ.get("NOISE_POOL_SIZE", "4"))
+# seconds between idle checks while there is nothing to do
+IDLE_POLL = 1.0
+# window for the refill rate reported by stats()
+RATE_WINDOW = 60.0
+
+
+class ImagePool:
+    def __init__(self, name, make_source, size, params):
+        self.name = name
+        self.make_source = make_source
+        self.size = size
+        self.params = params
+        self.images = deque()
+        self.served = 0
+        self.misses = 0
+        self.refilled = 0
+        self.failed = 0
+        self.refill_seconds = 0.0
+        self._refill_times = deque()
+
+    @property
+    def missing(self):
+        return self.size - len(self.images)
+
+    def stats(self, now):
+        while self._refill_times and now - self._refill_times[0] > RATE_WINDOW:
+            self._refill_times.popleft()
+        return {
+            "depth": len(self.images),
+            "size": self.size,
+            "served": self.served,
+            "misses": self.misses,
+            "refilled": self.refilled,
+            "failed": self.failed,
+            "refills_per_min": round(len(self._refill_times) * 60.0 / RATE_WINDOW, 2),
+            "mean_refill_seconds": round(self.refill_seconds / self.refilled, 3) if self.refilled else 0.0,
+        }
+
+
+class PoolManager:
+    def __init__(self, jobs=diffusion_jobs, model="sketch"):
+        """model: model_registry name of the pipeline the refills run on"""
+        self.jobs = jobs
+        self.model = model
+        self._used = False
+        self._pools = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, name, make_source, size=POOL_SIZE, **params):
+        """
+        Keep `size` images of sketch_to_image(make_source(), **params) ready.
+        make_source is called once per image, so it can vary the init image.
+        """
+        with self._lock:
+            self._pools[name] = ImagePool(name, make_source, size, params)
+        self._wake.set()
+
+    def take(self, name):
+        """Pop a pre-generated image, or None if the pool is empty or unknown."""
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None or pool.size <= 0:
+                return None
+            self._used = True
+            if pool.images:
+                pool.served += 1
+                img = pool.images.popleft()
+            else:
+                pool.misses += 1
+                img = None
+        self._wake.set()
+        return img
+
+    def start(self):
+        """Start the background refill thread (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="diffusion-pools", daemon=True)
+            self._thread.start()
+
+    def _next_pool(self):
+        """The pool furthest below its target size, or None if all are full."""
+        with self._lock:
+            pools = [p for p in self._pools.values() if p.missing > 0]
+            return max(pools, key=lambda p: p.missing) if pools else None
+
+    def _may_refill(self):
+        if model_registry.is_loaded(self.model):
+            return True
+        return self._used and model_registry.fits(self.model)
+
+    def _run(self):
+        while True:
+            pool = self._next_pool()
+            if pool is None or not self.jobs.idle() or not self._may_refill():
+                self._wake.wait(IDLE_POLL)
+                self._wake.clear()
+                continue
+
+            start = time.perf_counter()
+            try:
+                img = self.jobs.run(pool.make_source(), priority=LOW, **pool.params)
+            except QueueFull:
+                time.sleep(IDLE_POLL)
+                continue
+            except Exception as e:
+                log.warning("Refill of pool '%s' failed: %s", pool.name, e)
+                with self._lock:
+                    pool.failed += 1
+                time.sleep(IDLE_POLL)
+                continue
+
+            with self._lock:
+                pool.images.append(img)
+                pool.refilled += 1
+                pool.refill_seconds += time.perf_counter() - start
+                pool._refill_times.append(time.time())
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            return {name: pool.stats(now) for name, pool in self._pools.items()}
+
+
+noise_pools = PoolManager()
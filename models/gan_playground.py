@@ -1,16 +1,76 @@
 # models/gan_playground.py
+"""Tiny GAN playground.
+
+Generators are cached per latent_dim (GAN_CACHE_SIZE, least recently used
+evicted), so clients alternating dimensions do not rebuild models. Batches
+of samples or a latent-space interpolation walk come out of a single
+forward pass; the numpy fallback is vectorised over the batch the same way.
+"""
+import io
+import math
+import os
+import threading
+from collections import OrderedDict
+
 try:
     import torch
     import torch.nn as nn
+    import torch.nn.functional as F
     _HAS_TORCH = True
 except Exception:
     torch = None
     nn = None
+    F = None
     _HAS_TORCH = False
 
 from PIL import Image
 import numpy as np
 
+from instrumentation import model_timer
+
+GAN_CACHE_SIZE = int(os.environ.get("GAN_CACHE_SIZE", "4"))
+GAN_MAX_BATCH = int(os.environ.get("GAN_MAX_BATCH", "64"))
+GAN_MODES = ("samples", "interpolate")
+IMAGE_SIZE = 64
+
+
+def _latent_batch(count, latent_dim, noise_scale=1.0, mode="samples"):
+    """
+    (count, latent_dim) float32 latents: independent samples, or a spherical
+    interpolation walk between two random endpoints.
+    """
+    if mode == "interpolate" and count > 1:
+        z0, z1 = np.random.randn(2, latent_dim)
+        omega = math.acos(float(np.clip(
+            np.dot(z0, z1) / (np.linalg.norm(z0) * np.linalg.norm(z1)), -1.0, 1.0)))
+        t = np.linspace(0.0, 1.0, count)[:, None]
+        if omega < 1e-6:
+            z = (1 - t) * z0 + t * z1
+        else:
+            z = (np.sin((1 - t) * omega) * z0 + np.sin(t * omega) * z1) / math.sin(omega)
+    else:
+        z = np.random.randn(count, latent_dim)
+    return (noise_scale * z).astype(np.float32)
+
+
+def make_grid(images, columns=None):
+    """Tile equally sized PIL images into one sprite sheet, row-major."""
+    columns = columns or int(math.ceil(math.sqrt(len(images))))
+    rows = int(math.ceil(len(images) / columns))
+    w, h = images[0].size
+    grid = Image.new("RGB", (columns * w, rows * h))
+    for i, img in enumerate(images):
+        grid.paste(img, ((i % columns) * w, (i // columns) * h))
+    return grid
+
+
+def encode_animation(frames, frame_ms=80):
+    """Animated, looping WebP bytes of the frames."""
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format="WEBP", save_all=True, append_images=frames[1:],
+                   duration=frame_ms, loop=0, lossless=True)
+    return buffer.getvalue()
+
 
 if _HAS_TORCH:
     class TinyGenerator(nn.Module):
@@ -38,43 +98,76 @@ if _HAS_TORCH:
         def forward(self, z):
             return self.net(z)
 
+        def forward_per_sample(self, z):
+            """
+            Batched forward pass that gives every sample the output it would
+            get on its own: the untrained BatchNorm layers run in train mode,
+            i.e. on batch statistics, which for a batch of one are the
+            sample's own statistics. instance_norm computes exactly those.
+            """
+            x = z
+            for layer in self.net:
+                if isinstance(layer, nn.BatchNorm2d):
+                    x = F.instance_norm(x, weight=layer.weight, bias=layer.bias, eps=layer.eps)
+                else:
+                    x = layer(x)
+            return x
+
 
-    # Single generator instance (untrained)
     _device = "cuda" if torch.cuda.is_available() else "cpu"
-    _gen = TinyGenerator(latent_dim=16, base_channels=32).to(_device)
+    # latent_dim -> TinyGenerator (untrained), least recently used first
+    _generators = OrderedDict()
+    _gen_lock = threading.Lock()
 
 
-    def generate_gan_image(latent_dim=16, noise_scale=1.0):
-        """
-        Generate a single 64x64 image from random noise using a tiny PyTorch generator.
-        """
-        global _gen
+    def _get_generator(latent_dim):
+        with _gen_lock:
+            gen = _generators.get(latent_dim)
+            if gen is None:
+                gen = TinyGenerator(latent_dim=latent_dim, base_channels=32).to(_device)
+                _generators[latent_dim] = gen
+                while len(_generators) > max(1, GAN_CACHE_SIZE):
+                    _generators.popitem(last=False)
+            _generators.move_to_end(latent_dim)
+            return gen
 
-        if latent_dim != _gen.latent_dim:
-            # recreate generator with new latent dim
-            _gen = TinyGenerator(latent_dim=latent_dim, base_channels=32).to(_device)
 
-        z = noise_scale * torch.randn(1, latent_dim, 1, 1, device=_device)
-        with torch.no_grad():
-            img = _gen(z)[0]  # (3, 64, 64)
+    def generate_gan_images(latent_dim=16, noise_scale=1.0, count=1, mode="samples"):
+        """
+        Generate `count` 64x64 images in one forward pass.
+        mode: "samples" (independent) or "interpolate" (a walk between two
+        random latents). Returns a list of PIL images.
+        """
+        gen = _get_generator(latent_dim)
+        z = torch.from_numpy(_latent_batch(count, latent_dim, noise_scale, mode))
+        z = z.view(count, latent_dim, 1, 1).to(_device)
+        with torch.no_grad(), model_timer("gan"):
+            imgs = gen.forward_per_sample(z)  # (N, 3, 64, 64)
 
         # map from [-1,1] to [0,255]
-        img = (img.clamp(-1, 1) + 1) / 2
-        img_np = (img.permute(1, 2, 0).cpu().numpy() * 255).astype(np.uint8)
+        imgs = (imgs.clamp(-1, 1) + 1) / 2
+        imgs_np = (imgs.permute(0, 2, 3, 1).cpu().numpy() * 255).astype(np.uint8)
 
-        return Image.fromarray(img_np)
+        return [Image.fromarray(img) for img in imgs_np]
 
 else:
-    # Fallback: generate a simple procedural noise image using numpy
-    def generate_gan_image(latent_dim=16, noise_scale=1.0):
-        h = 64
-        w = 64
+    # Fallback: generate simple procedural noise images using numpy
+    def generate_gan_images(latent_dim=16, noise_scale=1.0, count=1, mode="samples"):
+        h = w = IMAGE_SIZE
         # mix several sine waves + random noise for visual variety
         xs = np.linspace(0, 3.14 * 2, w)
         ys = np.linspace(0, 3.14 * 2, h)
         xv, yv = np.meshgrid(xs, ys)
         base = (np.sin(xv * (1 + latent_dim % 5)) + np.cos(yv * (1 + latent_dim % 3)))
-        noise = noise_scale * np.random.randn(h, w)
-        img_np = (np.stack([base + noise, base * 0.5 + noise, base * -0.3 + noise], axis=2) * 127 + 128)
+        # one noise field per image; "interpolate" walks between two fields
+        noise = _latent_batch(count, h * w, noise_scale, mode).reshape(count, h, w)
+        img_np = (np.stack([base + noise, base * 0.5 + noise, base * -0.3 + noise], axis=3) * 127 + 128)
         img_np = np.clip(img_np, 0, 255).astype(np.uint8)
-        return Image.fromarray(img_np)
+        return [Image.fromarray(img) for img in img_np]
+
+
+def generate_gan_image(latent_dim=16, noise_scale=1.0):
+    """
+    Generate a single 64x64 image from random noise using a tiny PyTorch generator.
+    """
+    return generate_gan_images(latent_dim, noise_scale, count=1)[0]
@@ -0,0 +1,187 @@
+# models/image_io.py
+"""Shared image input for the model entry points.
+
+The detection, pose, segmentation and sketch functions accept a file path,
+raw encoded bytes, a file-like object, a PIL image, a numpy array (RGB) or an
+ImageInput. Whatever comes in is decoded at most once and the same pixels are
+handed to PIL consumers and to YOLO, so a request no longer writes the upload
+to disk and decodes it twice.
+
+Images larger than MAX_INPUT_SIDE (default 2048, 0 = no limit) are reduced
+while decoding: JPEGs decode straight at 1/2, 1/4 or 1/8 scale (PIL draft
+mode, landing between half and all of the limit), anything else is shrunk
+to fit. The returned images, overlays, crops and edit sessions are that
+working image, so a 12 MP phone photo costs about as much as a 2 MP one.
+
+The models get model_input(): the pixels shrunk further to INFERENCE_SIDE
+(default 640, the size YOLO letterboxes to anyway) plus the factors that
+map its coordinates onto the uploaded image. Boxes, keypoints and polygons
+are therefore always in the upload's own pixels; original_size and scale
+relate them to the working image.
+"""
+import hashlib
+import math
+import os
+import threading
+from io import BytesIO
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from instrumentation import stage
+from models.result_cache import content_hash
+
+MAX_INPUT_SIDE = int(os.environ.get("MAX_INPUT_SIDE", "2048"))
+INFERENCE_SIDE = int(os.environ.get("INFERENCE_SIDE", "640"))
+
+
+class ImageInput:
+    def __init__(self, data=None, path=None, pil=None, array=None, max_side=MAX_INPUT_SIDE):
+        """
+        data: encoded image bytes (PNG/JPEG/...)
+        path: file to read the encoded bytes from
+        pil: an already decoded PIL image
+        array: an already decoded HxWx3 uint8 RGB array
+        max_side: longest side of the working image (0 = full size)
+        """
+        self._data = data
+        self.path = path
+        self.max_side = max_side
+        if array is not None and self._too_big(array.shape[1], array.shape[0]):
+            pil, array = Image.fromarray(array), None
+        self._opened = pil
+        self._pil = None
+        self._rgb = array
+        self._bgr = None
+        self._model_input = None
+        self._original_size = (array.shape[1], array.shape[0]) if array is not None else None
+        self._digest = None
+        self._lock = threading.RLock()
+
+    def _too_big(self, w, h):
+        return bool(self.max_side) and max(w, h) > self.max_side
+
+    def _load(self, img):
+        """Working copy of an opened image: RGB, at most max_side wide and high."""
+        self._original_size = img.size
+        if self._too_big(*img.size):
+            w, h = img.size
+            ratio = self.max_side / max(w, h) / 2
+            # JPEG only: decode at the smallest 1/2^n scale that keeps at least
+            # half of max_side, which usually fits without any resampling
+            img.draft("RGB", (math.ceil(w * ratio), math.ceil(h * ratio)))
+            img = img.convert("RGB")
+            img.thumbnail((self.max_side, self.max_side))
+            return img
+        return img.convert("RGB")
+
+    @property
+    def data(self):
+        """Encoded bytes, if the image came from a file or an upload."""
+        if self._data is None and self.path is not None:
+            with open(self.path, "rb") as f:
+                self._data = f.read()
+        return self._data
+
+    @property
+    def pil(self):
+        with self._lock:
+            if self._pil is None:
+                if self._rgb is not None:
+                    self._pil = Image.fromarray(self._rgb)
+                elif self._opened is not None:
+                    self._pil = self._load(self._opened)
+                    self._opened = None
+                else:
+                    with stage("decode"):
+                        self._pil = self._load(Image.open(BytesIO(self.data)))
+            return self._pil
+
+    @property
+    def rgb(self):
+        """Read-only HxWx3 RGB view of the decoded pixels."""
+        if self._rgb is None:
+            self._rgb = np.asarray(self.pil)
+        return self._rgb
+
+    @property
+    def bgr(self):
+        """Contiguous BGR copy, the layout Ultralytics expects for arrays."""
+        with self._lock:
+            if self._bgr is None:
+                self._bgr = np.ascontiguousarray(self.rgb[:, :, ::-1])
+            return self._bgr
+
+    @property
+    def size(self):
+        return self.pil.size
+
+    @property
+    def original_size(self):
+        """(width, height) of the image as uploaded."""
+        if self._original_size is None:
+            self.pil
+        return self._original_size
+
+    @property
+    def scale(self):
+        """(x, y) factors from working-image to original coordinates."""
+        (ow, oh), (w, h) = self.original_size, self.size
+        return ow / w, oh / h
+
+    def model_input(self, side=INFERENCE_SIDE):
+        """
+        (bgr, (sx, sy)): contiguous BGR pixels at most `side` wide and high,
+        and the factors mapping their coordinates onto the uploaded image.
+        """
+        with self._lock:
+            if self._model_input is None:
+                rgb = self.rgb
+                h, w = rgb.shape[:2]
+                if side and max(w, h) > side:
+                    ratio = side / max(w, h)
+                    size = (max(1, round(w * ratio)), max(1, round(h * ratio)))
+                    small = cv2.resize(rgb, size, interpolation=cv2.INTER_AREA)
+                    bgr = np.ascontiguousarray(small[:, :, ::-1])
+                else:
+                    bgr = self.bgr
+                ow, oh = self.original_size
+                self._model_input = (bgr, (ow / bgr.shape[1], oh / bgr.shape[0]))
+            return self._model_input
+
+    @property
+    def geometry(self):
+        """Working and inference size limits, part of result cache keys:
+        results depend on the pixels the model saw."""
+        return f"{self.max_side}:{INFERENCE_SIDE}"
+
+    @property
+    def digest(self):
+        """Content hash: of the encoded bytes when known, else of the pixels."""
+        if self._digest is None:
+            if self.data is not None:
+                self._digest = content_hash(self.data)
+            else:
+                rgb = np.ascontiguousarray(self.rgb)
+                h = hashlib.sha256(str(rgb.shape).encode("utf-8"))
+                h.update(rgb.data)
+                self._digest = h.hexdigest()
+        return self._digest
+
+
+def as_image_input(source):
+    """Wrap any supported image source in an ImageInput (no decoding yet)."""
+    if isinstance(source, ImageInput):
+        return source
+    if isinstance(source, (str, os.PathLike)):
+        return ImageInput(path=os.fspath(source))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return ImageInput(data=bytes(source))
+    if isinstance(source, Image.Image):
+        return ImageInput(pil=source)
+    if isinstance(source, np.ndarray):
+        return ImageInput(array=source)
+    if hasattr(source, "read"):
+        return ImageInput(data=source.read())
+    raise TypeError(f"Unsupported image source: {type(source).__name__}")
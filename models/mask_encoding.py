@@ -0,0 +1,115 @@
+# models/mask_encoding.py
+"""Compact encodings for segmentation masks.
+
+run_segmentation produces float polygons ("polygon", the default). For
+JSON responses they can be re-encoded as:
+  "simplified"  Douglas-Peucker simplified polygons (`tolerance` in pixels)
+  "int16"       rounded points packed as base64 little-endian int16 x,y pairs
+  "rle"         COCO-style uncompressed RLE of the filled mask
+                ({"size": [h, w], "counts": [...]}, column-major)
+
+Every encoder works on whole numpy arrays per instance; there is no Python
+loop over points.
+"""
+import base64
+
+import cv2
+import numpy as np
+
+MASK_FORMATS = ("polygon", "simplified", "int16", "rle")
+
+
+def simplify_polygon(points, tolerance=1.0):
+    pts = np.asarray(points, dtype=np.float32).reshape(-1, 1, 2)
+    approx = cv2.approxPolyDP(pts, float(tolerance), True)
+    return np.round(approx.reshape(-1, 2), 1).tolist()
+
+
+def pack_int16(points):
+    pts = np.clip(np.round(np.asarray(points, dtype=np.float32)), -32768, 32767)
+    data = pts.astype("<i2").reshape(-1)
+    return {
+        "dtype": "int16",
+        "count": int(data.size // 2),
+        "data": base64.b64encode(data.tobytes()).decode("ascii"),
+    }
+
+
+def polygon_to_rle(points, height, width):
+    """COCO RLE of a filled polygon, rasterised only inside its bounding box."""
+    pts = np.round(np.asarray(points, dtype=np.float32)).astype(np.int32).reshape(-1, 2)
+    total = height * width
+    if len(pts) == 0:
+        return {"size": [height, width], "counts": [total]}
+
+    # rasterise over the polygon's own bounds (OpenCV's edge clipping would
+    # shift pixels), then crop to the image
+    px1, py1 = pts.min(axis=0)
+    px2, py2 = pts.max(axis=0) + 1
+    shape_mask = np.zeros((py2 - py1, px2 - px1), dtype=np.uint8)
+    cv2.fillPoly(shape_mask, [(pts - [px1, py1]).reshape(-1, 1, 2)], 1)
+
+    x1, y1 = max(int(px1), 0), max(int(py1), 0)
+    x2, y2 = min(int(px2), width), min(int(py2), height)
+    if x2 <= x1 or y2 <= y1:
+        return {"size": [height, width], "counts": [total]}
+
+    # one empty row above and below, so runs never continue from one column
+    # into the next
+    padded_h = y2 - y1 + 2
+    local = np.zeros((padded_h, x2 - x1), dtype=np.uint8)
+    local[1:-1] = shape_mask[y1 - py1:y2 - py1, x1 - px1:x2 - px1]
+
+    flat = local.ravel(order="F").astype(np.int8)
+    d = np.diff(flat)
+    starts = np.flatnonzero(d == 1) + 1
+    ends = np.flatnonzero(d == -1) + 1
+    if len(starts) == 0:
+        return {"size": [height, width], "counts": [total]}
+
+    def to_global(idx):
+        col, row = np.divmod(idx, padded_h)
+        return (x1 + col) * height + (row - 1 + y1)
+
+    starts = to_global(starts)
+    ends = to_global(ends)
+
+    # a run touching the bottom of one column and the top of the next is
+    # a single run in the image-wide column-major order
+    keep = np.ones(len(starts), dtype=bool)
+    keep[1:] = starts[1:] != ends[:-1]
+    run_starts = starts[keep]
+    run_ends = ends[np.append(np.flatnonzero(keep)[1:] - 1, len(ends) - 1)]
+
+    boundaries = np.empty(2 * len(run_starts), dtype=np.int64)
+    boundaries[0::2] = run_starts
+    boundaries[1::2] = run_ends
+    if boundaries[-1] != total:
+        boundaries = np.append(boundaries, total)
+    counts = np.diff(np.concatenate(([0], boundaries)))
+    return {"size": [height, width], "counts": counts.tolist()}
+
+
+def encode_segments(seg_results, mask_format="polygon", tolerance=1.0, image_size=None):
+    """
+    Return a copy of `seg_results` with each 'mask' in `mask_format`.
+    image_size: (width, height), required for "rle".
+    """
+    if mask_format not in MASK_FORMATS:
+        raise ValueError(f"Unknown mask format: {mask_format}")
+    if mask_format == "polygon":
+        return seg_results
+    if mask_format == "rle" and image_size is None:
+        raise ValueError("image_size is required for RLE masks")
+
+    encoded = []
+    for res in seg_results:
+        if mask_format == "simplified":
+            mask = simplify_polygon(res["mask"], tolerance)
+        elif mask_format == "int16":
+            mask = pack_int16(res["mask"])
+        else:
+            width, height = image_size
+            mask = polygon_to_rle(res["mask"], height, width)
+        encoded.append(dict(res, mask=mask, mask_format=mask_format))
+    return encoded
@@ -0,0 +1,130 @@
+# models/preload.py
+"""Load models once in a pre-fork server's master process.
+
+With PRELOAD_MODELS set, gunicorn.conf.py calls preload_models() in the
+master before any worker is forked. The weights are then loaded once, and
+every worker maps the same physical pages instead of holding a copy.
+
+  - each model is loaded and warmed up through model_registry.warm(), so
+    lazy setup (YOLO's predictor and fused layers) also happens before
+    the fork
+  - with PRELOAD_SHARED_TENSORS (default on) parameters and buffers are
+    moved into shared memory. Those pages stay shared even when a worker
+    writes near them, which plain copy-on-write does not guarantee.
+  - gc.freeze() moves everything loaded so far out of the collector's
+    reach, so collections in the workers do not touch (and copy) the
+    pages holding these objects
+
+memory_usage() reports this process's unique versus shared memory from
+/proc/self/smaps_rollup; /api/memory and /metrics expose it per worker.
+
+Configuration:
+  PRELOAD_MODELS           comma separated model names, or "all"
+  PRELOAD_SHARED_TENSORS   1 (default) to move weights into shared memory
+"""
+import gc
+import logging
+import os
+import time
+
+from models.registry import model_registry, torch_modules
+
+log = logging.getLogger(__name__)
+
+PRELOAD_MODELS = [m.strip() for m in os.environ.get("PRELOAD_MODELS", "").split(",") if m.strip()]
+SHARED_TENSORS = os.environ.get("PRELOAD_SHARED_TENSORS", "1") == "1"
+
+# names preloaded in this process (or inherited from the master)
+preloaded = []
+
+
+def _import_model_modules():
+    # importing registers the loaders with model_registry
+    import models.detection  # noqa: F401
+    import models.segmentation  # noqa: F401
+    import models.sketch_diffusion  # noqa: F401
+
+
+def _share_weights(name, model):
+    try:
+        for module in torch_modules(model):
+            module.share_memory()
+    except Exception as e:
+        # e.g. a /dev/shm too small for the weights; copy-on-write still applies
+        log.warning("Could not move '%s' weights to shared memory: %s", name, e)
+
+
+def _cuda_in_use():
+    try:
+        import torch
+        return torch.cuda.is_available()
+    except Exception:
+        return False
+
+
+def preload_models(names=None):
+    """
+    Load, warm up and share `names` (default: PRELOAD_MODELS) in this
+    process, then freeze the GC. Call it once, before forking workers.
+    """
+    names = PRELOAD_MODELS if names is None else names
+    if not names:
+        return []
+    if _cuda_in_use():
+        # a CUDA context does not survive fork()
+        log.warning("PRELOAD_MODELS is ignored on CUDA hosts; workers load their own models")
+        return []
+
+    _import_model_modules()
+    if names == ["all"]:
+        names = model_registry.names()
+
+    start = time.perf_counter()
+    for name in names:
+        if name not in model_registry.names():
+            log.warning("Cannot preload unknown or unavailable model '%s'", name)
+            continue
+        if not model_registry.warm(name):
+            continue
+        if SHARED_TENSORS:
+            _share_weights(name, model_registry.get(name))
+        preloaded.append(name)
+
+    gc.collect()
+    gc.freeze()
+    log.info("Preloaded %s in %.1fs (%d objects frozen)",
+             preloaded, time.perf_counter() - start, gc.get_freeze_count())
+    return list(preloaded)
+
+
+_SMAPS_FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared",
+    "Shared_Dirty": "shared",
+    "Private_Clean": "private",
+    "Private_Dirty": "private",
+}
+
+
+def memory_usage():
+    """
+    This process's memory in bytes: rss, pss (rss with shared pages divided
+    among the processes mapping them), shared and private (unique to this
+    process). Only rss is available without /proc/self/smaps_rollup.
+    """
+    usage = {"rss": 0, "pss": 0, "shared": 0, "private": 0}
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            for line in f:
+                field, _, rest = line.partition(":")
+                key = _SMAPS_FIELDS.get(field)
+                if key is not None:
+                    usage[key] += int(rest.split()[0]) * 1024
+    except (OSError, ValueError, IndexError):
+        try:
+            with open("/proc/self/statm", "r") as f:
+                usage["rss"] = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, IndexError):
+            pass
+    return usage
@@ -0,0 +1,276 @@
+# models/registry.py
+"""Central registry for the heavy models (YOLO detect/pose/seg, Stable Diffusion).
+
+Models are loaded on first use, or ahead of time by warm_up(). Each loaded
+model's resident size is recorded, and when the total goes over the
+configured budget the least-recently-used models are unloaded, so a box that
+cannot hold SD plus three YOLO models still serves every endpoint.
+
+Configuration:
+  MODEL_MEMORY_BUDGET_MB  total RAM for loaded models (0 = unlimited)
+  MODEL_WARMUP            comma separated model names to load at startup
+"""
+import gc
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+MEMORY_BUDGET_MB = float(os.environ.get("MODEL_MEMORY_BUDGET_MB", "0"))
+WARMUP_MODELS = [m.strip() for m in os.environ.get("MODEL_WARMUP", "detect").split(",") if m.strip()]
+
+# seconds to wait before retrying a model that failed to load
+RETRY_AFTER = 60.0
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def torch_modules(model):
+    """The torch modules inside `model`: itself, a YOLO's .model or a diffusers
+    pipeline's components."""
+    try:
+        import torch.nn as nn
+    except Exception:
+        return []
+
+    modules = []
+    if isinstance(model, nn.Module):
+        modules.append(model)
+    inner = getattr(model, "model", None)
+    if isinstance(inner, nn.Module):
+        modules.append(inner)
+    components = getattr(model, "components", None)
+    if isinstance(components, dict):
+        modules.extend(c for c in components.values() if isinstance(c, nn.Module))
+    return modules
+
+
+def model_nbytes(model):
+    """Bytes held by the parameters and buffers of the torch modules in `model`."""
+    seen = set()
+    total = 0
+    for module in torch_modules(model):
+        for t in list(module.parameters()) + list(module.buffers()):
+            ptr = t.data_ptr()
+            if ptr in seen:
+                continue
+            seen.add(ptr)
+            total += t.numel() * t.element_size()
+    return total
+
+
+class _Entry:
+    def __init__(self, name, loader, warm=None):
+        self.name = name
+        self.loader = loader
+        self.warm = warm
+        self.model = None
+        self.nbytes = 0
+        self.load_seconds = None
+        self.loads = 0
+        self.evictions = 0
+        self.last_used = None
+        self.error = None
+        self.failed_at = None
+        self.lock = threading.Lock()
+
+
+class ModelRegistry:
+    def __init__(self, budget_mb=MEMORY_BUDGET_MB):
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self._entries = {}
+        self._lru = OrderedDict()  # loaded model names, least recent first
+        self._lock = threading.Lock()
+        self._warmup = []
+        self._warmup_done = threading.Event()
+        self._warmup_done.set()
+
+    def register(self, name, loader, warm=None):
+        """
+        Register `loader` (a no-argument callable returning the model).
+        warm: optional callable taking the model, run by warm() to finish
+        lazy setup with a dummy inference (see models/preload.py).
+        """
+        with self._lock:
+            if name not in self._entries:
+                self._entries[name] = _Entry(name, loader, warm)
+
+    def names(self):
+        return list(self._entries)
+
+    def get(self, name):
+        """Return the loaded model, loading it if needed. None if unavailable."""
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+
+        model = entry.model
+        if model is None:
+            model = self._load(entry)
+            if model is None:
+                return None
+
+        with self._lock:
+            entry.last_used = time.time()
+            if name in self._lru:
+                self._lru.move_to_end(name)
+        return model
+
+    def _load(self, entry):
+        with entry.lock:
+            if entry.model is not None:
+                return entry.model
+            if entry.failed_at is not None and time.time() - entry.failed_at < RETRY_AFTER:
+                return None
+
+            log.info("Loading model '%s'...", entry.name)
+            rss_before = _rss_bytes()
+            start = time.perf_counter()
+            try:
+                model = entry.loader()
+            except Exception as e:
+                log.error("Failed to load model '%s': %s", entry.name, e)
+                entry.error = str(e)
+                entry.failed_at = time.time()
+                return None
+
+            entry.load_seconds = round(time.perf_counter() - start, 3)
+            entry.nbytes = model_nbytes(model) or max(0, _rss_bytes() - rss_before)
+            entry.loads += 1
+            entry.error = None
+            entry.failed_at = None
+            entry.model = model
+            log.info("Model '%s' loaded in %ss (%.1f MB)",
+                     entry.name, entry.load_seconds, entry.nbytes / 2**20)
+
+        with self._lock:
+            self._lru[entry.name] = True
+            self._lru.move_to_end(entry.name)
+        self._enforce_budget(keep=entry.name)
+        return model
+
+    def _enforce_budget(self, keep):
+        if self.budget_bytes <= 0:
+            return
+        evicted = False
+        with self._lock:
+            while self.loaded_bytes() > self.budget_bytes:
+                victim = next((n for n in self._lru if n != keep), None)
+                if victim is None:
+                    break
+                self._drop(victim)
+                evicted = True
+        if evicted:
+            self._release_memory()
+
+    def _drop(self, name):
+        entry = self._entries[name]
+        log.info("Evicting model '%s' (%.1f MB)", name, entry.nbytes / 2**20)
+        entry.model = None
+        entry.evictions += 1
+        self._lru.pop(name, None)
+
+    @staticmethod
+    def _release_memory():
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except Exception:
+            pass
+
+    def unload(self, name):
+        with self._lock:
+            if name in self._lru:
+                self._drop(name)
+        self._release_memory()
+
+    def warm(self, name):
+        """Load `name` and run its warm-up callable. False if unavailable."""
+        model = self.get(name)
+        if model is None:
+            return False
+        entry = self._entries[name]
+        if entry.warm is not None:
+            start = time.perf_counter()
+            entry.warm(model)
+            log.info("Model '%s' warmed up in %.2fs", name, time.perf_counter() - start)
+        return True
+
+    def loaded_bytes(self):
+        return sum(self._entries[n].nbytes for n in self._lru)
+
+    def fits(self, name):
+        """
+        True if loading `name` would not evict other models under the memory
+        budget (its size is known once it has been loaded). Also True when
+        `name` is loaded or there is no budget; False if it is not registered.
+        """
+        entry = self._entries.get(name)
+        if entry is None:
+            return False
+        if entry.model is not None or self.budget_bytes <= 0:
+            return True
+        with self._lock:
+            return self.loaded_bytes() + entry.nbytes <= self.budget_bytes
+
+    def is_loaded(self, name):
+        entry = self._entries.get(name)
+        return entry is not None and entry.model is not None
+
+    def warm_up(self, names=None, background=True):
+        """Load `names` (default: MODEL_WARMUP) now, optionally on a thread."""
+        names = [n for n in (WARMUP_MODELS if names is None else names) if n in self._entries]
+        self._warmup = names
+        if not names:
+            return
+        self._warmup_done.clear()
+
+        def run():
+            try:
+                for name in names:
+                    self.get(name)
+            finally:
+                self._warmup_done.set()
+
+        if background:
+            threading.Thread(target=run, name="model-warmup", daemon=True).start()
+        else:
+            run()
+
+    def status(self):
+        with self._lock:
+            models = {
+                name: {
+                    "loaded": e.model is not None,
+                    "memory_mb": round(e.nbytes / 2**20, 1),
+                    "load_seconds": e.load_seconds,
+                    "loads": e.loads,
+                    "evictions": e.evictions,
+                    "last_used": e.last_used,
+                    "error": e.error,
+                }
+                for name, e in self._entries.items()
+            }
+            return {
+                "ready": self._warmup_done.is_set() and all(
+                    self._entries[n].model is not None for n in self._warmup
+                ),
+                "warmup": list(self._warmup),
+                "budget_mb": round(self.budget_bytes / 2**20, 1),
+                "loaded_mb": round(self.loaded_bytes() / 2**20, 1),
+                "models": models,
+            }
+
+
+model_registry = ModelRegistry()
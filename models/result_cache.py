@@ -0,0 +1,218 @@
+# models/result_cache.py
+"""Content-addressed cache for model results.
+
+Results are keyed by a hash of the input image bytes plus the model name and
+version, so re-uploads of the same picture (and repeated boss rounds on the
+same few images) skip inference entirely.
+
+Two tiers:
+  - an in-memory LRU bounded by entry count
+  - an optional on-disk tier (one file per key) that survives restarts,
+    optionally capped in bytes (least recently used files are removed first)
+
+Values are stored through a codec: JSON for detection-style results, PNG for
+generated images.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+log = logging.getLogger(__name__)
+
+
+def content_hash(data):
+    """Hex digest of raw image bytes used as the content part of cache keys."""
+    return hashlib.sha256(data).hexdigest()
+
+
+class JsonCodec:
+    ext = ".json"
+
+    @staticmethod
+    def dumps(value):
+        return json.dumps(value).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode("utf-8"))
+
+
+class PngCodec:
+    """PIL images; entries of Image.info that are ints or strings survive."""
+    ext = ".png"
+
+    @staticmethod
+    def dumps(img):
+        from PIL.PngImagePlugin import PngInfo
+
+        meta = PngInfo()
+        for k, v in img.info.items():
+            if isinstance(v, (int, str)):
+                meta.add_text(k, str(v))
+        buf = io.BytesIO()
+        img.save(buf, format="PNG", pnginfo=meta)
+        return buf.getvalue()
+
+    @staticmethod
+    def loads(data):
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        for k, v in list(img.info.items()):
+            if isinstance(v, str) and v.lstrip("-").isdigit():
+                img.info[k] = int(v)
+        return img
+
+
+class ResultCache:
+    def __init__(self, max_entries=256, disk_dir=None, max_disk_bytes=0, codec=JsonCodec):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes  # 0 = unlimited
+        self.codec = codec
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_files())
+
+    @staticmethod
+    def make_key(digest, model_name, model_version):
+        return hashlib.sha256(
+            f"{digest}:{model_name}:{model_version}".encode("utf-8")
+        ).hexdigest()
+
+    def _disk_path(self, key):
+        # shard by the first two hex chars so no directory grows too large
+        return os.path.join(self.disk_dir, key[:2], f"{key}{self.codec.ext}")
+
+    def _disk_files(self):
+        """(mtime, path, size) of every entry in the disk tier."""
+        files = []
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith(self.codec.ext):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, path, st.st_size))
+        return files
+
+    def _trim_disk(self):
+        """Remove the least recently used files until the tier is under 90% of its cap."""
+        target = int(self.max_disk_bytes * 0.9)
+        files = sorted(self._disk_files())
+        total = sum(size for _, _, size in files)
+        for _, path, size in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.disk_evictions += 1
+        self._disk_bytes = total
+
+    def get(self, key):
+        """Return the cached value for `key`, or None on a miss."""
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return self._mem[key]
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    value = self.codec.loads(f.read())
+                # mtime doubles as the last-use time for disk eviction
+                os.utime(path)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                    self._put_mem(key, value)
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._put_mem(key, value)
+
+        if self.disk_dir:
+            path = self._disk_path(key)
+            try:
+                data = self.codec.dumps(value)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "wb") as f:
+                    f.write(data)
+                try:
+                    # an overwritten entry no longer counts towards the total
+                    replaced = os.path.getsize(path)
+                except OSError:
+                    replaced = 0
+                os.replace(tmp, path)
+            except OSError as e:
+                log.warning("Failed to write result cache entry: %s", e)
+                return
+            with self._lock:
+                self._disk_bytes += len(data) - replaced
+                if self.max_disk_bytes and self._disk_bytes > self.max_disk_bytes:
+                    self._trim_disk()
+
+    def _put_mem(self, key, value):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.max_entries:
+            self._mem.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "entries": len(self._mem),
+                "max_entries": self.max_entries,
+                "disk_dir": self.disk_dir,
+                "disk_mb": round(self._disk_bytes / 2**20, 2),
+                "max_disk_mb": round(self.max_disk_bytes / 2**20, 2),
+                "disk_evictions": self.disk_evictions,
+            }
+
+
+# Shared cache for the YOLO-based vision models. Configure with
+# RESULT_CACHE_SIZE (entries kept in RAM), RESULT_CACHE_DIR (enables the
+# on-disk tier) and RESULT_CACHE_DISK_MB (caps it, 0 = unlimited).
+result_cache = ResultCache(
+    max_entries=int(os.environ.get("RESULT_CACHE_SIZE", "256")),
+    disk_dir=os.environ.get("RESULT_CACHE_DIR") or None,
+    max_disk_bytes=int(float(os.environ.get("RESULT_CACHE_DISK_MB", "0")) * 2**20),
+)
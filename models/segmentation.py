@@ -1,63 +1,103 @@
-from ultralytics import YOLO
 from PIL import Image
+import logging
 import numpy as np
 import cv2
 
-_seg_model = None
+from instrumentation import stage
+from models.result_cache import result_cache
+from models.batching import BatchScheduler
+from models.image_io import as_image_input
+from models.registry import model_registry
+from models.mask_encoding import encode_segments
+from models.detection import YOLO, _HAS_ULTRALYTICS, _predict_with, _model_ready, _warm_yolo, _cache_key, _infer, to_working
+from models.workers import predictor, use_workers
 
-def run_segmentation(image_path):
-    """
-    Runs Instance Segmentation on the image using YOLOv8-Seg.
-    Returns:
-      results: List of dicts with 'bbox', 'label', and 'mask' (polygon points)
-      overlay_img: PIL Image with masks drawn
-    """
-    global _seg_model
-    img = Image.open(image_path).convert("RGB")
-    
-    if _seg_model is None:
-        try:
-            print("DEBUG: Loading YOLOv8-Seg model...")
-            _seg_model = YOLO("yolov8n-seg.pt")
-        except Exception as e:
-            print(f"DEBUG: Failed to load Seg model: {e}")
-            return [], img
-            
-    try:
-        results = _seg_model(image_path)[0]
-    except Exception as e:
-        print(f"DEBUG: Error during segmentation: {e}")
-        return [], img
-        
+log = logging.getLogger(__name__)
+
+SEG_WEIGHTS = "yolov8n-seg.pt"
+
+if _HAS_ULTRALYTICS and not use_workers():
+    model_registry.register("seg", lambda: YOLO(SEG_WEIGHTS), warm=_warm_yolo)
+
+
+def _segments_from(results):
     seg_results = []
-    
-    # Create an overlay image
-    img_cv = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-    
+
     if results.masks is not None:
+        # one tensor -> list conversion for all boxes instead of one per box
+        boxes = results.boxes.xyxy.int().tolist()
+        classes = results.boxes.cls.int().tolist()
         for i, mask in enumerate(results.masks.xy):
             # mask is an array of [x, y] points
             if len(mask) == 0: continue
-            
-            box = results.boxes[i].xyxy[0].tolist()
-            label_idx = int(results.boxes[i].cls[0])
-            label = results.names[label_idx]
-            
+
             seg_results.append({
-                "bbox": [int(b) for b in box],
+                "bbox": boxes[i],
                 "mask": mask.tolist(),
-                "label": label
+                "label": results.names[classes[i]]
             })
-            
-            # Draw on overlay
-            pts = np.array(mask, np.int32)
-            pts = pts.reshape((-1, 1, 2))
-            color = (0, 255, 0) if label == "person" else (255, 0, 255)
-            cv2.fillPoly(img_cv, [pts], color)
-            
+    return seg_results
+
+
+predict_seg = _predict_with("seg", _segments_from)
+
+_seg_batcher = BatchScheduler(
+    "seg", predictor("seg", "models.segmentation:predict_seg", predict_seg))
+
+
+def _render_overlay(rgb, seg_results):
+    """Blend the instance polygons of `seg_results` over an RGB array."""
+    filled = rgb.copy()
+
+    for res in seg_results:
+        pts = np.array(res["mask"], np.int32)
+        pts = pts.reshape((-1, 1, 2))
+        # green / magenta read the same in RGB and BGR order
+        color = (0, 255, 0) if res["label"] == "person" else (255, 0, 255)
+        cv2.fillPoly(filled, [pts], color)
+
     # Blend overlay
     alpha = 0.5
-    img_cv_orig = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-    cv2.addWeighted(img_cv, alpha, img_cv_orig, 1 - alpha, 0, img_cv)
-    
-    return seg_results, Image.fromarray(cv2.cvtColor(img_cv, cv2.COLOR_BGR2RGB))
+    cv2.addWeighted(filled, alpha, rgb, 1 - alpha, 0, filled)
+
+    return Image.fromarray(filled)
+
+
+def run_segmentation(image_source, mask_format="polygon", tolerance=1.0):
+    """
+    Runs Instance Segmentation on the image using YOLOv8-Seg.
+    image_source: path, encoded bytes, PIL image, RGB array or ImageInput
+    mask_format: "polygon" (default), "simplified", "int16" or "rle",
+                 see models/mask_encoding.py
+    Returns:
+      results: List of dicts with 'bbox', 'label', and 'mask' (polygon points),
+               in the uploaded image's pixels
+      overlay_img: PIL Image with masks drawn (the working image, see
+                   models/image_io.py)
+    """
+    inp = as_image_input(image_source)
+    img = inp.pil
+
+    if not _HAS_ULTRALYTICS:
+        return [], img
+
+    cache_key = _cache_key(inp, SEG_WEIGHTS)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        overlay = _render_overlay(inp.rgb, to_working(cached, inp))
+        return encode_segments(cached, mask_format, tolerance, inp.original_size), overlay
+
+    if not _model_ready("seg"):
+        return [], img
+
+    try:
+        seg_results = _infer(_seg_batcher, inp)
+    except Exception as e:
+        log.error("Segmentation inference failed: %s", e)
+        return [], img
+
+    result_cache.put(cache_key, seg_results)
+
+    with stage("postprocess"):
+        overlay = _render_overlay(inp.rgb, to_working(seg_results, inp))
+        return encode_segments(seg_results, mask_format, tolerance, inp.original_size), overlay
@@ -1,112 +1,512 @@
 # models/sketch_diffusion.py
-from PIL import Image, ImageFilter, ImageOps, ImageEnhance, ImageDraw
+from PIL import Image
 import numpy as np
+import json
+import logging
+import math
+import os
+import queue
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from instrumentation import model_timer
+from models.diffusion_jobs import diffusion_jobs, DONE, NORMAL
+from models.image_io import as_image_input
+from models.registry import model_registry
+from models.result_cache import ResultCache, PngCodec, content_hash
+from models.stylize import stylize_batch
+
+log = logging.getLogger(__name__)
 
 _HAS_DIFFUSERS = True
 try:
     from diffusers import StableDiffusionImg2ImgPipeline
     import torch
 except Exception as e:
-    print(f"DEBUG: Could not import diffusers/torch: {e}")
+    log.warning("Could not import diffusers/torch: %s", e)
     StableDiffusionImg2ImgPipeline = None
     torch = None
     _HAS_DIFFUSERS = False
 
 # You can change this to a lighter model if needed
 MODEL_ID = "stabilityai/sd-turbo"
+# Tiny VAE with the same latent space, used by profiles with tiny_vae
+TINY_VAE_ID = "madebyollin/taesd"
+
+# Built-in prompts; their embeddings are computed when the model loads
+DEFAULT_PROMPT = "a cute digital art, clean, high quality"
+PURIFY_PROMPT = "beautiful futuristic clean sci-fi city tile, isometric, high quality, glowing blue energy"
+MONSTER_PROMPT = "scary glitch monster, pixel art, dark void creature, red eyes, detailed"
+BUILTIN_PROMPTS = (DEFAULT_PROMPT, PURIFY_PROMPT, MONSTER_PROMPT)
+PROMPT_CACHE_SIZE = int(os.environ.get("PROMPT_CACHE_SIZE", "32"))
+
+# Runtime profiles, selected with RUNTIME_PROFILE. Any option can be
+# overridden with SD_<OPTION>=0/1 (e.g. SD_COMPILE=1).
+#   max_steps          cap on num_inference_steps (turbo models need 1-4)
+#   guidance_scale     forced guidance (turbo models are trained without CFG,
+#                      and <= 1 skips the unconditional UNet pass)
+#   tiny_vae           decode/encode with TAESD instead of the full VAE
+#   attention_slicing  lower peak memory at a small speed cost
+#   channels_last      NHWC layout for the UNet and VAE convolutions
+#   bf16               bfloat16 weights when the CPU supports it
+#   compile            torch.compile the UNet, warmed up at load time
+RUNTIME_PROFILES = {
+    "default": {
+        "max_steps": None, "guidance_scale": None, "tiny_vae": False,
+        "attention_slicing": False, "channels_last": False, "bf16": False, "compile": False,
+    },
+    "cpu-fast": {
+        "max_steps": 2, "guidance_scale": 0.0, "tiny_vae": True,
+        "attention_slicing": True, "channels_last": True, "bf16": True, "compile": False,
+    },
+}
+
+
+def _runtime_profile():
+    name = os.environ.get("RUNTIME_PROFILE", "default")
+    if name not in RUNTIME_PROFILES:
+        log.warning("Unknown RUNTIME_PROFILE '%s', using 'default'", name)
+        name = "default"
+    profile = dict(RUNTIME_PROFILES[name])
+    for key, value in profile.items():
+        override = os.environ.get(f"SD_{key.upper()}")
+        if override is not None and isinstance(value, bool):
+            profile[key] = override.lower() in ("1", "true", "yes")
+    return name, profile
+
+
+PROFILE_NAME, PROFILE = _runtime_profile()
 
-_pipe = None
 _device = None
+
+
+def _cpu_supports_bf16():
+    """True if the CPU has native bfloat16 instructions (AVX512-BF16 or AMX)."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def _torch_dtype():
+    if _device == "cuda":
+        return torch.float16
+    if PROFILE["bf16"] and _cpu_supports_bf16():
+        return torch.bfloat16
+    return torch.float32
+
+
+def _load_pipe():
+    dtype = _torch_dtype()
+    log.info("Loading sketch diffusion model on %s (profile %s, %s)", _device, PROFILE_NAME, dtype)
+    pipe = StableDiffusionImg2ImgPipeline.from_pretrained(MODEL_ID, torch_dtype=dtype)
+    if PROFILE["tiny_vae"]:
+        from diffusers import AutoencoderTiny
+        pipe.vae = AutoencoderTiny.from_pretrained(TINY_VAE_ID, torch_dtype=dtype)
+    pipe = pipe.to(_device)
+
+    if PROFILE["attention_slicing"]:
+        pipe.enable_attention_slicing()
+    if PROFILE["channels_last"]:
+        pipe.unet.to(memory_format=torch.channels_last)
+        pipe.vae.to(memory_format=torch.channels_last)
+    if PROFILE["compile"]:
+        # keep compiled graphs on disk so restarts skip most of the compile
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        pipe.unet = torch.compile(pipe.unet)
+        # compile now (during warm-up) rather than on the first request
+        steps, guidance = _profile_steps(15, 3.0, 0.8)
+        pipe(prompt="warm-up", image=Image.new("RGB", (512, 512), (255, 255, 255)),
+             strength=0.8, num_inference_steps=steps, guidance_scale=guidance)
+
+    _, guidance = _profile_steps(15, 3.0, 0.8)
+    for prompt in BUILTIN_PROMPTS:
+        _encode_prompt(pipe, prompt, guidance > 1)
+    return pipe
+
+
+class _PromptCache:
+    """
+    LRU of text-encoder outputs: (prompt, negative_prompt, cfg) ->
+    (prompt_embeds, negative_prompt_embeds). With classifier-free guidance
+    the negative embeddings are the unconditional ones for an empty
+    negative prompt.
+    """
+
+    def __init__(self, max_entries=PROMPT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.encode_count = 0
+        self.encode_seconds = 0.0
+        self.encode_max = 0.0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, seconds):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self.encode_count += 1
+            self.encode_seconds += seconds
+            self.encode_max = max(self.encode_max, seconds)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "text_encoder_calls": self.encode_count,
+                "text_encoder_mean_seconds": round(self.encode_seconds / self.encode_count, 4)
+                if self.encode_count else 0.0,
+                "text_encoder_max_seconds": round(self.encode_max, 4),
+            }
+
+
+prompt_cache = _PromptCache()
+
+
+def _encode_prompt(_pipe, prompt, do_cfg, negative_prompt=None):
+    """Cached (prompt_embeds, negative_prompt_embeds or None) for one image."""
+    key = (prompt, negative_prompt, do_cfg)
+    cached = prompt_cache.get(key)
+    if cached is not None:
+        return cached
+
+    start = time.perf_counter()
+    with torch.no_grad(), model_timer("text_encoder"):
+        embeds = _pipe.encode_prompt(prompt, _device, 1, do_cfg, negative_prompt=negative_prompt)
+    prompt_cache.put(key, embeds, time.perf_counter() - start)
+    return embeds
+
+
+# Quality tiers of sketch_to_images
+QUALITY_TIERS = ("full", "preview", "refine")
+PREVIEW_SIZE = 256
+PREVIEW_STEPS = 2
+# the refine pass only needs to add detail to the upscaled preview
+REFINE_STEPS = 4
+REFINE_STRENGTH = 0.35
+
+
+def _profile_steps(num_inference_steps, guidance_scale, strength):
+    """Apply the profile's step and guidance presets to a request."""
+    if PROFILE["max_steps"]:
+        num_inference_steps = min(num_inference_steps, PROFILE["max_steps"])
+    if PROFILE["guidance_scale"] is not None:
+        guidance_scale = PROFILE["guidance_scale"]
+    # img2img runs int(steps * strength) steps; keep at least one
+    num_inference_steps = max(num_inference_steps, int(math.ceil(1.0 / max(strength, 1e-3))))
+    return num_inference_steps, guidance_scale
+
+
 if _HAS_DIFFUSERS and torch is not None:
     _device = "cuda" if torch.cuda.is_available() else "cpu"
-    try:
-        print(f"DEBUG: Attempting to load sketch diffusion model on {_device}...")
-        _pipe = StableDiffusionImg2ImgPipeline.from_pretrained(
-            MODEL_ID,
-            torch_dtype=torch.float16 if _device == "cuda" else torch.float32
-        )
-        _pipe = _pipe.to(_device)
-        print("DEBUG: Sketch diffusion model loaded successfully!")
-    except Exception as e:
-        print(f"DEBUG: Failed to load sketch diffusion model: {e}")
-        _pipe = None
+    # loaded on first use or at warm-up, see models/registry.py
+    model_registry.register("sketch", _load_pipe)
 else:
-    print("DEBUG: Diffusers/torch not available, will use fallback")
-
-
-def _fallback_stylize(image_path, style="cartoon"):
-    """Lightweight fallback: apply image processing to create a stylized version."""
-    print("DEBUG: Using fallback stylization (no diffusion model available)")
-    img = Image.open(image_path).convert("RGB")
-    
-    # Resize to standard size
-    img = img.resize((512, 512))
-    
-    # Apply cartoon-like effect:
-    # 1. Enhance colors
-    enhancer = ImageEnhance.Color(img)
-    img = enhancer.enhance(1.5)
-    
-    # 2. Enhance contrast
-    enhancer = ImageEnhance.Contrast(img)
-    img = enhancer.enhance(1.3)
-    
-    # 3. Apply edge detection and combine
-    edges = img.filter(ImageFilter.FIND_EDGES)
-    
-    # 4. Apply smoothing
-    img = img.filter(ImageFilter.SMOOTH_MORE)
-    
-    # 5. Slightly sharpen
-    img = img.filter(ImageFilter.SHARPEN)
-    
-    return img
-
-
-def sketch_to_image(image_path,
+    log.warning("Diffusers/torch not available, will use fallback")
+
+
+# Generated images, keyed by the thresholded sketch plus every generation
+# parameter and the seed, so only seeded requests can hit. Configure with
+# DIFFUSION_CACHE_SIZE (images kept in RAM), DIFFUSION_CACHE_DIR (enables the
+# on-disk tier) and DIFFUSION_CACHE_DISK_MB (caps it).
+diffusion_cache = ResultCache(
+    max_entries=int(os.environ.get("DIFFUSION_CACHE_SIZE", "64")),
+    disk_dir=os.environ.get("DIFFUSION_CACHE_DIR") or None,
+    max_disk_bytes=int(float(os.environ.get("DIFFUSION_CACHE_DISK_MB", "512")) * 2**20),
+    codec=PngCodec,
+)
+
+
+def new_seed():
+    return random.randrange(2**32)
+
+
+def _generator(seed):
+    # CPU generator: the same seed gives the same initial noise on any device
+    return torch.Generator(device="cpu").manual_seed(int(seed))
+
+
+def _cache_key(init_image, seed, **params):
+    version = json.dumps(dict(params, seed=seed), sort_keys=True)
+    return ResultCache.make_key(content_hash(init_image.tobytes()), f"{MODEL_ID}@{_device}/{PROFILE_NAME}", version)
+
+
+def _fallback_stylize(image_sources, style="cartoon", size=512):
+    """
+    Lightweight fallback: stylize a batch of images with fused OpenCV
+    operations, see models/stylize.py. Returns a list of PIL images.
+    """
+    log.debug("Using fallback stylization (no diffusion model available)")
+    with model_timer("stylize"):
+        out = stylize_batch([as_image_input(src).rgb for src in image_sources], style=style, size=size)
+    return [Image.fromarray(img) for img in out]
+
+
+class GenerationCancelled(Exception):
+    """Raised from the step callback to abort a running pipeline."""
+
+
+# Linear map from SD latent channels to approximate RGB, used for cheap
+# previews of intermediate steps without running the VAE decoder
+_LATENT_RGB_FACTORS = np.array([
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+], dtype=np.float32)
+
+
+def latents_to_preview(latents):
+    """Low-resolution (1/8 scale) RGB preview of a latent batch's first item."""
+    lat = latents[0].detach().float().cpu().numpy()  # (4, h, w)
+    rgb = np.tensordot(lat, _LATENT_RGB_FACTORS, axes=([0], [0]))  # (h, w, 3)
+    rgb = np.clip((rgb + 1.0) * 127.5, 0, 255).astype(np.uint8)
+    return Image.fromarray(rgb)
+
+
+def _preprocess_sketch(image_source, size=512):
+    """Resize and threshold the sketch so its lines dominate the init image."""
+    init_image = image_source.pil.resize((size, size))
+
+    # Light preprocessing: increase contrast / threshold to emphasize sketch lines
+    arr = np.array(init_image.convert("L"))
+    arr = ((arr < 200) * 255).astype(np.uint8)  # Explicitly cast to uint8
+    return Image.fromarray(arr).convert("RGB")
+
+
+def _run_pipe(_pipe, on_step=None, **kwargs):
+    """Call the pipeline, forwarding each finished step to on_step(step, total, latents)."""
+    if on_step is not None:
+        def callback(pipe, step, timestep, callback_kwargs):
+            on_step(step + 1, getattr(pipe, "num_timesteps", None), callback_kwargs["latents"])
+            return callback_kwargs
+
+        kwargs["callback_on_step_end"] = callback
+        kwargs["callback_on_step_end_tensor_inputs"] = ["latents"]
+
+    with model_timer("sketch"):
+        if _device == "cuda":
+            with torch.autocast(_device):
+                return _pipe(**kwargs)
+        return _pipe(**kwargs)
+
+
+def sketch_to_image(image_source,
                     guidance_scale=3.0,
                     num_inference_steps=15,
-                    prompt="a cute digital art, clean, high quality",
+                    prompt=DEFAULT_PROMPT,
                     style="cartoon",
-                    strength=0.8):
+                    strength=0.8,
+                    seed=None,
+                    quality="full",
+                    on_step=None):
     """
     Convert rough sketch to nicer image using img2img. If diffusers/torch
     are not available, uses a lightweight PIL-based stylization fallback.
+    image_source: path, encoded bytes, PIL image, RGB array or ImageInput
+    seed: makes the result reproducible and cacheable; without one a random
+          seed is drawn. The seed used is returned in image.info["seed"].
+    quality: "full", "preview" or "refine", see sketch_to_images
+    on_step: optional callable(step, total, latents) run after every
+             denoising step; raising GenerationCancelled aborts the pipeline
+    """
+    return sketch_to_images([image_source],
+                            guidance_scale=guidance_scale,
+                            num_inference_steps=num_inference_steps,
+                            prompt=prompt,
+                            style=style,
+                            strength=strength,
+                            seeds=[seed],
+                            quality=quality,
+                            on_step=on_step)[0]
+
+
+def sketch_to_images(image_sources,
+                     guidance_scale=3.0,
+                     num_inference_steps=15,
+                     prompt=DEFAULT_PROMPT,
+                     style="cartoon",
+                     strength=0.8,
+                     seeds=None,
+                     quality="full",
+                     on_step=None):
+    """
+    Batched sketch_to_image: all sketches share the generation parameters
+    and go through the pipeline in one call. `seeds` is one seed (or None)
+    per sketch; seeded results are served from diffusion_cache when present.
+    quality: "full" (512px), "preview" (PREVIEW_SIZE, at most PREVIEW_STEPS
+    steps) or "refine" (the preview upscaled to 512 plus a short img2img
+    pass; a seeded refine reuses the cached preview of the same seed).
+    Returns a list of PIL images.
     """
+    if quality not in QUALITY_TIERS:
+        raise ValueError(f"Unknown quality tier: {quality}")
+    image_sources = [as_image_input(src) for src in image_sources]
+    _pipe = model_registry.get("sketch")
     if _pipe is None:
-        print("DEBUG: Sketch diffusion model not loaded, using fallback")
-        return _fallback_stylize(image_path, style=style)
+        log.debug("Sketch diffusion model not loaded, using fallback")
+        size = PREVIEW_SIZE if quality == "preview" else 512
+        return _fallback_stylize(image_sources, style=style, size=size)
 
-    print("DEBUG: Using Stable Diffusion for sketch-to-image")
-    init_image = Image.open(image_path).convert("RGB")
-    init_image = init_image.resize((512, 512))
+    # both tiers start from the same thresholded 512px sketch
+    sketches = [_preprocess_sketch(src) for src in image_sources]
+    seeds = list(seeds) if seeds is not None else [None] * len(sketches)
+    # unseeded results can never be requested again, so only seeded ones are cached
+    cacheable = [seed is not None for seed in seeds]
+    seeds = [new_seed() if seed is None else seed for seed in seeds]
+    request = dict(prompt=prompt, strength=strength,
+                   guidance_scale=guidance_scale, num_inference_steps=num_inference_steps)
+    return _generate(_pipe, image_sources, sketches, seeds, cacheable,
+                     quality, request, style, on_step)
 
-    # Light preprocessing: increase contrast / threshold to emphasize sketch lines
-    arr = np.array(init_image.convert("L"))
-    arr = ((arr < 200) * 255).astype(np.uint8)  # Explicitly cast to uint8
-    init_image = Image.fromarray(arr).convert("RGB")
 
+def _generate(_pipe, image_sources, sketches, seeds, cacheable, quality, request, style, on_step=None):
+    """
+    One quality tier of sketch_to_images. `request` holds the caller's
+    generation parameters, which are part of every tier's cache key.
+    """
+    key_params = dict(request)
+    if quality in ("preview", "refine"):
+        # both only ever run the preview's steps (plus REFINE_STEPS)
+        key_params["num_inference_steps"] = min(request["num_inference_steps"], PREVIEW_STEPS)
+    results = [None] * len(sketches)
+    keys = [None] * len(sketches)
+    for i, sketch in enumerate(sketches):
+        if cacheable[i]:
+            keys[i] = _cache_key(sketch, seeds[i], quality=quality, **key_params)
+            results[i] = diffusion_cache.get(keys[i])
+
+    todo = [i for i, img in enumerate(results) if img is None]
+    if not todo:
+        log.debug("Sketch-to-image (%s) served from cache", quality)
+        return results
+
+    steps = request["num_inference_steps"]
+    strength = request["strength"]
+    if quality == "preview":
+        inits = [sketches[i].resize((PREVIEW_SIZE, PREVIEW_SIZE), Image.BILINEAR) for i in todo]
+        steps = min(steps, PREVIEW_STEPS)
+    elif quality == "refine":
+        previews = _generate(_pipe, [image_sources[i] for i in todo], [sketches[i] for i in todo],
+                             [seeds[i] for i in todo], [cacheable[i] for i in todo], "preview",
+                             request, style)
+        inits = [p.resize((512, 512), Image.BICUBIC) for p in previews]
+        steps, strength = REFINE_STEPS, REFINE_STRENGTH
+    else:
+        inits = [sketches[i] for i in todo]
+    steps, guidance_scale = _profile_steps(steps, request["guidance_scale"], strength)
+    # the pipeline gets precomputed embeddings instead of re-encoding the prompt
+    prompt_embeds, negative_embeds = _encode_prompt(_pipe, request["prompt"], guidance_scale > 1)
+    embeds = {"prompt_embeds": prompt_embeds.repeat(len(todo), 1, 1)}
+    if negative_embeds is not None:
+        embeds["negative_prompt_embeds"] = negative_embeds.repeat(len(todo), 1, 1)
+
+    log.debug("Using Stable Diffusion for sketch-to-image (%s, batch of %d)", quality, len(todo))
     try:
-        if _device == "cuda":
-            with torch.autocast(_device):
-                out = _pipe(
-                    prompt=prompt,
-                    image=init_image,
-                    strength=strength,
-                    guidance_scale=guidance_scale,
-                    num_inference_steps=num_inference_steps
-                )
-        else:
-            out = _pipe(
-                prompt=prompt,
-                image=init_image,
-                strength=strength,
-                guidance_scale=guidance_scale,
-                num_inference_steps=num_inference_steps
-            )
-        gen_img = out.images[0]
-        print("DEBUG: Sketch-to-image generation successful")
-        return gen_img
+        out = _run_pipe(
+            _pipe,
+            on_step=on_step,
+            image=inits,
+            generator=[_generator(seeds[i]) for i in todo],
+            strength=strength,
+            guidance_scale=guidance_scale,
+            num_inference_steps=steps,
+            **embeds
+        )
+    except GenerationCancelled:
+        log.info("Sketch generation cancelled")
+        raise
     except Exception as e:
-        print(f"DEBUG: Error during sketch generation: {e}")
-        return _fallback_stylize(image_path, style=style)
+        log.error("Sketch generation failed, using fallback: %s", e)
+        size = PREVIEW_SIZE if quality == "preview" else 512
+        fallback = _fallback_stylize([image_sources[i] for i in todo], style=style, size=size)
+        for i, img in zip(todo, fallback):
+            results[i] = img
+        return results
+
+    for i, img in zip(todo, out.images):
+        img.info["seed"] = seeds[i]
+        results[i] = img
+        if keys[i] is not None:
+            diffusion_cache.put(keys[i], img)
+    return results
+
+
+# seconds between keepalive events of a stream that has nothing to report
+STREAM_KEEPALIVE = 2.0
+
+
+def sketch_to_image_stream(image_source, preview_every=2, priority=NORMAL, **kwargs):
+    """
+    Streaming variant of sketch_to_image. Returns a generator of events:
+      ("progress", step, total, preview)  preview is a small PIL image every
+                                          `preview_every` steps, else None
+      ("done", image)                     the final image
+      ("error", message)
+      ("keepalive",)                      every STREAM_KEEPALIVE seconds
+                                          without progress (e.g. queued)
+    The generation is a job on the diffusion queue like any other (QueueFull
+    is raised here, before the first event). Closing the generator (e.g. the
+    client disconnected) cancels the job, or aborts it after the current
+    step once it runs.
+    """
+    events = queue.Queue()
+    cancel = threading.Event()
+
+    def on_step(step, total, latents):
+        if cancel.is_set():
+            raise GenerationCancelled()
+        preview = None
+        if preview_every and step % preview_every == 0 and step != total:
+            preview = latents_to_preview(latents)
+        events.put(("progress", step, total, preview))
+
+    job = diffusion_jobs.submit(image_source, priority=priority, on_step=on_step, **kwargs)
+    return _job_events(job, events, cancel)
+
+
+def _job_events(job, events, cancel):
+    try:
+        # on_step runs before the job finishes, so once it is done every
+        # progress event is already queued
+        quiet_since = time.monotonic()
+        while not job.done() or not events.empty():
+            try:
+                yield events.get(timeout=0.25)
+                quiet_since = time.monotonic()
+            except queue.Empty:
+                # writing something is the only way to notice that the
+                # client went away while the job is still queued
+                if time.monotonic() - quiet_since >= STREAM_KEEPALIVE:
+                    yield ("keepalive",)
+                    quiet_since = time.monotonic()
+        if job.status == DONE:
+            yield ("done", job.result)
+        else:
+            yield ("error", job.error or f"Generation {job.status}")
+    finally:
+        cancel.set()
+        diffusion_jobs.cancel_job(job)
@@ -0,0 +1,90 @@
+# models/sprites.py
+"""Sprite extraction for the Target Tagger.
+
+Each segmented object is cut out as an RGBA sprite. Its mask is rasterised
+only inside the padded bounding box, so memory follows object area instead
+of image area times object count. pack_atlas() can then pack all sprites into
+a single texture plus a coordinate map, so the client decodes one image.
+"""
+import math
+
+import cv2
+import numpy as np
+
+SPRITE_PAD = 5
+
+
+def extract_sprites(rgb, seg_results, pad=SPRITE_PAD):
+    """
+    Cut every instance of `seg_results` out of the HxWx3 RGB array.
+    Returns a list of (info, rgba) where info = {id, label, width, height, bbox}
+    and rgba is an hxwx4 uint8 array.
+    """
+    h, w = rgb.shape[:2]
+    sprites = []
+
+    for i, res in enumerate(seg_results):
+        # Crop to bbox plus some padding
+        x1, y1, x2, y2 = res["bbox"]
+        x1 = max(0, x1 - pad)
+        y1 = max(0, y1 - pad)
+        x2 = min(w, x2 + pad)
+        y2 = min(h, y2 + pad)
+        if x2 <= x1 or y2 <= y1:
+            continue
+
+        # Mask rasterised in crop coordinates only
+        mask_pts = (np.asarray(res["mask"], dtype=np.float32).astype(np.int32)
+                    - np.array([x1, y1], dtype=np.int32))
+        alpha = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.fillPoly(alpha, [mask_pts.reshape(-1, 1, 2)], 255)
+        rgba = np.dstack((rgb[y1:y2, x1:x2], alpha))
+
+        sprites.append(({
+            "id": i,
+            "label": res["label"],
+            "width": x2 - x1,
+            "height": y2 - y1,
+            "bbox": [x1, y1, x2, y2],
+        }, rgba))
+
+    return sprites
+
+
+def pack_atlas(sprites, spacing=1, max_width=4096):
+    """
+    Shelf-pack (info, rgba) sprites into one RGBA texture.
+    Returns (atlas array, frames) where each frame is the sprite info plus
+    its x/y position inside the atlas.
+    """
+    if not sprites:
+        return np.zeros((1, 1, 4), dtype=np.uint8), []
+
+    widest = max(rgba.shape[1] for _, rgba in sprites)
+    area = sum((rgba.shape[0] + spacing) * (rgba.shape[1] + spacing) for _, rgba in sprites)
+    atlas_w = min(max_width, max(widest, int(math.ceil(math.sqrt(area) * 1.2))))
+    atlas_w = max(atlas_w, widest)
+
+    # tallest first keeps shelves tight
+    order = sorted(range(len(sprites)), key=lambda i: -sprites[i][1].shape[0])
+    positions = {}
+    x = y = shelf_h = 0
+    for i in order:
+        sh, sw = sprites[i][1].shape[:2]
+        if x + sw > atlas_w:
+            x = 0
+            y += shelf_h + spacing
+            shelf_h = 0
+        positions[i] = (x, y)
+        x += sw + spacing
+        shelf_h = max(shelf_h, sh)
+    atlas_h = y + shelf_h
+
+    atlas = np.zeros((atlas_h, atlas_w, 4), dtype=np.uint8)
+    frames = []
+    for i, (info, rgba) in enumerate(sprites):
+        px, py = positions[i]
+        sh, sw = rgba.shape[:2]
+        atlas[py:py + sh, px:px + sw] = rgba
+        frames.append(dict(info, x=px, y=py))
+    return atlas, frames
@@ -0,0 +1,295 @@
+# models/workers.py
+"""Worker processes for the YOLO model families.
+
+With MODEL_WORKERS > 0 each family (detect, pose, seg) gets that many
+spawned processes, each holding its own copy of the model, so forward
+passes run in parallel without sharing the GIL or the module globals of
+the Flask process. A WorkerPool is a drop-in predict_batch for a
+BatchScheduler (see models/batching.py), which then runs one batch per
+worker at a time.
+
+Images travel through a shared memory segment per worker: the parent
+copies the batch's pixels in and sends only offsets and shapes over the
+pipe. The target function runs in the worker and must return picklable
+results.
+
+Every worker is pinned to its own slice of the CPUs this process may use
+and limits torch to that many threads. A worker that crashes or stops
+answering is killed and restarted, with exponential backoff when it
+keeps failing; the batch it was running fails with WorkerCrashed.
+
+Configuration:
+  MODEL_WORKERS          processes per model family (0 = run in threads)
+  MODEL_WORKER_THREADS   torch threads per worker (0 = an equal share of the CPUs)
+  MODEL_WORKER_TIMEOUT   seconds a batch may take before its worker is restarted
+"""
+import atexit
+import importlib
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+MODEL_WORKERS = int(os.environ.get("MODEL_WORKERS", "0"))
+WORKER_THREADS = int(os.environ.get("MODEL_WORKER_THREADS", "0"))
+WORKER_TIMEOUT = float(os.environ.get("MODEL_WORKER_TIMEOUT", "120"))
+
+# restart backoff: doubles per crash within CRASH_WINDOW seconds, capped
+RESTART_DELAY = 0.5
+MAX_RESTART_DELAY = 30.0
+CRASH_WINDOW = 60.0
+
+WORKER_NAME_PREFIX = "model-worker-"
+
+# True inside a worker process, so the modules it imports run models in
+# place. Spawn names the process before it re-imports __main__, so this
+# already holds while app.py is being imported there.
+in_worker = multiprocessing.current_process().name.startswith(WORKER_NAME_PREFIX)
+
+# name -> WorkerPool, for stats reporting and CPU partitioning
+pools = {}
+
+
+class WorkerCrashed(RuntimeError):
+    pass
+
+
+def use_workers():
+    """True in the Flask process when model families run in worker processes."""
+    return MODEL_WORKERS > 0 and not in_worker
+
+
+def _available_cpus():
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def _cpu_slices(count):
+    """`count` disjoint CPU lists (shared round-robin when there are fewer CPUs)."""
+    cpus = _available_cpus()
+    per = WORKER_THREADS or max(1, len(cpus) // max(1, count))
+    return [[cpus[(i * per + j) % len(cpus)] for j in range(per)] for i in range(count)]
+
+
+def _worker_main(name, target, conn, cpus):
+    """Entry point of a worker process (spawned, so imports start fresh)."""
+    threads = str(len(cpus))
+    os.environ["OMP_NUM_THREADS"] = threads
+    os.environ["MKL_NUM_THREADS"] = threads
+    try:
+        os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError):
+        pass
+    try:
+        import torch
+        torch.set_num_threads(len(cpus))
+        torch.set_num_interop_threads(1)
+    except Exception:
+        pass
+
+    module_name, func_name = target.split(":")
+    predict = getattr(importlib.import_module(module_name), func_name)
+    from models.registry import model_registry
+    model_registry.get(name)
+
+    segment = None
+    while True:
+        try:
+            msg = conn.recv()
+        except EOFError:
+            break
+        if msg is None:
+            break
+        shm_name, layout = msg
+        if segment is None or segment.name != shm_name:
+            if segment is not None:
+                segment.close()
+            segment = shared_memory.SharedMemory(name=shm_name)
+        arrays = [np.ndarray(shape, dtype=np.uint8, buffer=segment.buf, offset=offset)
+                  for offset, shape in layout]
+        try:
+            reply = ("ok", predict(arrays))
+        except Exception as e:
+            reply = ("error", f"{type(e).__name__}: {e}")
+        del arrays
+        conn.send(reply)
+    if segment is not None:
+        segment.close()
+
+
+class _Worker:
+    def __init__(self, pool, slot, cpus):
+        self.pool = pool
+        self.slot = slot
+        self.cpus = cpus
+        self.process = None
+        self.conn = None
+        self.segment = None
+        self.batches = 0
+        self.crashes = []
+
+    def start(self):
+        ctx = multiprocessing.get_context("spawn")
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(self.pool.name, self.pool.target, child_conn, self.cpus),
+            name=f"{WORKER_NAME_PREFIX}{self.pool.name}-{self.slot}", daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        if self.process is not None and self.process.is_alive():
+            self.process.kill()
+            self.process.join(5)
+        if self.conn is not None:
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def restart(self):
+        now = time.time()
+        self.crashes = [t for t in self.crashes if now - t < CRASH_WINDOW] + [now]
+        self.stop()
+        delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** (len(self.crashes) - 1))
+        log.warning("Restarting %s worker %d in %.1fs", self.pool.name, self.slot, delay)
+        time.sleep(delay)
+        self.start()
+
+    def _write(self, arrays):
+        """Copy the batch into this worker's segment; returns [(offset, shape)]."""
+        arrays = [np.ascontiguousarray(a, dtype=np.uint8) for a in arrays]
+        nbytes = sum(a.nbytes for a in arrays)
+        if self.segment is None or self.segment.size < nbytes:
+            if self.segment is not None:
+                self.segment.close()
+                self.segment.unlink()
+            size = max(nbytes, 2 * self.segment.size if self.segment is not None else 0)
+            self.segment = shared_memory.SharedMemory(create=True, size=size)
+
+        layout = []
+        offset = 0
+        for a in arrays:
+            view = np.ndarray(a.shape, dtype=np.uint8, buffer=self.segment.buf, offset=offset)
+            view[...] = a
+            del view
+            layout.append((offset, a.shape))
+            offset += a.nbytes
+        return layout
+
+    def run(self, arrays):
+        layout = self._write(arrays)
+        self.conn.send((self.segment.name, layout))
+        if not self.conn.poll(WORKER_TIMEOUT):
+            raise TimeoutError(f"no reply in {WORKER_TIMEOUT:.0f}s")
+        status, payload = self.conn.recv()
+        self.batches += 1
+        if status != "ok":
+            raise RuntimeError(payload)
+        return payload
+
+    def close(self):
+        self.stop()
+        if self.segment is not None:
+            self.segment.close()
+            self.segment.unlink()
+            self.segment = None
+
+
+class WorkerPool:
+    def __init__(self, name, target, workers=MODEL_WORKERS):
+        """
+        name: model family, also the model_registry name loaded at startup
+        target: "module:function" taking a list of HxWx3 uint8 arrays and
+                returning one picklable result per array
+        """
+        self.name = name
+        self.target = target
+        self.concurrency = max(1, workers)
+        self._workers = []
+        self._idle = queue.Queue()
+        self._start_lock = threading.Lock()
+        pools[name] = self
+
+    def start(self):
+        """Spawn the worker processes (idempotent). The CPUs are split evenly
+        over the workers of every pool created so far."""
+        with self._start_lock:
+            if self._workers:
+                return
+            slot = 0
+            for pool in pools.values():
+                if pool is self:
+                    break
+                slot += pool.concurrency
+            total = sum(p.concurrency for p in pools.values())
+            slices = _cpu_slices(total)
+            for i in range(self.concurrency):
+                worker = _Worker(self, i, slices[slot + i])
+                worker.start()
+                self._workers.append(worker)
+                self._idle.put(worker)
+            log.info("Started %d %s workers", self.concurrency, self.name)
+
+    def __call__(self, arrays):
+        """predict_batch: run one batch on the next idle worker."""
+        self.start()
+        worker = self._idle.get()
+        try:
+            return worker.run(arrays)
+        except (EOFError, OSError, TimeoutError) as e:
+            worker.restart()
+            raise WorkerCrashed(f"{self.name} worker {worker.slot} failed: {e!r}") from e
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+
+    def stats(self):
+        return {
+            "workers": [
+                {
+                    "pid": w.process.pid if w.process is not None else None,
+                    "alive": w.process is not None and w.process.is_alive(),
+                    "cpus": w.cpus,
+                    "batches": w.batches,
+                    "recent_crashes": len(w.crashes),
+                }
+                for w in self._workers
+            ],
+            "idle": self._idle.qsize(),
+        }
+
+
+def worker_pool_stats():
+    return {name: p.stats() for name, p in pools.items()}
+
+
+def start_worker_pools():
+    for pool in list(pools.values()):
+        pool.start()
+
+
+@atexit.register
+def _close_pools():
+    for pool in list(pools.values()):
+        pool.close()
+
+
+def predictor(name, target, local):
+    """
+    predict_batch for model family `name`: `local` (run in the calling
+    thread), or a WorkerPool running `target` when MODEL_WORKERS > 0.
+    """
+    return WorkerPool(name, target) if use_workers() else local
@@ -0,0 +1,209 @@
+# responses.py
+"""Image response encoding for the API endpoints.
+
+By default every endpoint keeps its existing shape: JSON with base64 PNG
+strings. Clients can opt into something cheaper:
+
+  ?format=png|jpeg|webp   image encoding (or an image/* type in Accept)
+  ?quality=1..100         JPEG/WebP quality
+  ?response=binary        raw image bytes, the JSON fields in X-Result-Meta
+                          (also chosen by an Accept of only image/* types);
+                          falls back to multipart when the fields would make
+                          the header longer than MAX_META_HEADER bytes
+  ?response=multipart     streamed multipart/mixed body: one JSON part, then
+                          one binary part per image (or Accept: multipart/mixed)
+"""
+import base64
+import json
+import uuid
+from io import BytesIO
+
+from flask import Response, jsonify, request
+from PIL import Image
+
+from instrumentation import stage
+
+# format name -> (PIL format, mimetype)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+MIMETYPES = {mime: name for name, (_, mime) in FORMATS.items()}
+DEFAULT_FORMAT = "png"
+DEFAULT_QUALITY = {"jpeg": 85, "webp": 80}
+# proxies and gunicorn reject header fields from about 8 KB
+MAX_META_HEADER = 4096
+
+
+def sniff_format(data):
+    """Format name of encoded image bytes, from their magic number."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def encode_image(img, fmt=DEFAULT_FORMAT, quality=None):
+    """Encode a PIL image to bytes in `fmt` ("png", "jpeg" or "webp")."""
+    pil_format = FORMATS[fmt][0]
+    buffer = BytesIO()
+    if fmt == "png":
+        img.save(buffer, format=pil_format)
+    else:
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffer, format=pil_format, quality=quality or DEFAULT_QUALITY[fmt])
+    return buffer.getvalue()
+
+
+def pil_to_base64(img, fmt=DEFAULT_FORMAT, quality=None):
+    return base64.b64encode(encode_image(img, fmt, quality)).decode("utf-8")
+
+
+class EncodedImage:
+    """An image that is already encoded (e.g. precomputed at upload time).
+
+    It is sent as-is unless the client explicitly asks for another format.
+    """
+
+    def __init__(self, data=None, b64=None):
+        self._data = data
+        self._b64 = b64
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = base64.b64decode(self._b64)
+        return self._data
+
+    @property
+    def b64(self):
+        if self._b64 is None:
+            self._b64 = base64.b64encode(self._data).decode("utf-8")
+        return self._b64
+
+    @property
+    def format(self):
+        return sniff_format(self.data)
+
+    def to_pil(self):
+        return Image.open(BytesIO(self.data))
+
+
+class Encoding:
+    def __init__(self, fmt=DEFAULT_FORMAT, quality=None, explicit=False, mode="json"):
+        self.fmt = fmt
+        self.quality = quality
+        self.explicit = explicit
+        self.mode = mode
+
+    @property
+    def mimetype(self):
+        return FORMATS[self.fmt][1]
+
+    def _reuse(self, img):
+        return isinstance(img, EncodedImage) and (
+            not self.explicit or (img.format == self.fmt and self.quality is None)
+        )
+
+    def to_bytes(self, img):
+        if self._reuse(img):
+            return img.data
+        if isinstance(img, EncodedImage):
+            img = img.to_pil()
+        return encode_image(img, self.fmt, self.quality)
+
+    def to_base64(self, img):
+        if self._reuse(img):
+            return img.b64
+        return base64.b64encode(self.to_bytes(img)).decode("utf-8")
+
+    def mimetype_of(self, img):
+        if self._reuse(img):
+            return FORMATS.get(img.format, FORMATS[DEFAULT_FORMAT])[1]
+        return self.mimetype
+
+
+def _explicit_accept():
+    """Mimetypes the client listed in Accept, ignoring wildcards."""
+    return [mime for mime, q in request.accept_mimetypes if q > 0 and "*" not in mime]
+
+
+def negotiate_encoding(allow_alpha=False):
+    """Read the requested image format, quality and response mode."""
+    accepted = _explicit_accept()
+
+    fmt = (request.args.get("format") or "").lower()
+    if fmt == "jpg":
+        fmt = "jpeg"
+    if fmt not in FORMATS:
+        fmt = next((MIMETYPES[m] for m in accepted if m in MIMETYPES), None)
+    explicit = fmt is not None
+    fmt = fmt or DEFAULT_FORMAT
+    if allow_alpha and fmt == "jpeg":
+        # JPEG has no alpha channel; keep transparency intact
+        fmt = DEFAULT_FORMAT
+
+    quality = request.args.get("quality", type=int)
+    if quality is not None:
+        quality = max(1, min(100, quality))
+
+    mode = (request.args.get("response") or "").lower()
+    if mode not in ("json", "binary", "multipart"):
+        if "multipart/mixed" in accepted:
+            mode = "multipart"
+        elif accepted and all(m.startswith("image/") for m in accepted):
+            mode = "binary"
+        else:
+            mode = "json"
+
+    return Encoding(fmt, quality, explicit, mode)
+
+
+def image_response(payload, images, encoding=None):
+    """
+    Build the response for `payload` (JSON-serialisable dict) plus `images`
+    (name -> PIL image or EncodedImage) in the encoding the client asked for.
+    """
+    encoding = encoding or negotiate_encoding()
+
+    if encoding.mode == "binary" and len(images) == 1:
+        (name, img), = images.items()
+        meta = json.dumps(dict(payload, image_field=name))
+        if len(meta) <= MAX_META_HEADER:
+            with stage("encode"):
+                data = encoding.to_bytes(img)
+            return Response(
+                data,
+                mimetype=encoding.mimetype_of(img),
+                headers={"X-Result-Meta": meta},
+            )
+
+    if encoding.mode in ("binary", "multipart"):
+        boundary = uuid.uuid4().hex
+
+        def generate():
+            yield (f"--{boundary}\r\nContent-Type: application/json\r\n\r\n"
+                   f"{json.dumps(payload)}\r\n").encode("utf-8")
+            for name, img in images.items():
+                data = encoding.to_bytes(img)
+                yield (f"--{boundary}\r\nContent-Type: {encoding.mimetype_of(img)}\r\n"
+                       f"Content-Disposition: attachment; name=\"{name}\"\r\n"
+                       f"Content-Length: {len(data)}\r\n\r\n").encode("utf-8")
+                yield data
+                yield b"\r\n"
+            yield f"--{boundary}--\r\n".encode("utf-8")
+
+        return Response(generate(), mimetype=f"multipart/mixed; boundary={boundary}")
+
+    body = dict(payload)
+    with stage("encode"):
+        for name, img in images.items():
+            body[name] = encoding.to_base64(img)
+    if encoding.explicit and encoding.fmt != DEFAULT_FORMAT:
+        body["image_format"] = encoding.fmt
+    return jsonify(body)
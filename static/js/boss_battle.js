@@ -114,7 +114,9 @@ class BossBattle {
       this.btnAnalyze.disabled = true;
       this.btnAnalyze.innerHTML = '<i class="fa-solid fa-spinner fa-spin"></i> Analyzing...';
       
-      const resp = await fetch("/api/boss/analyze", { method: "POST" });
+      const formData = new FormData();
+      if (this.bossId) formData.append("id", this.bossId);
+      const resp = await fetch("/api/boss/analyze", { method: "POST", body: formData });
       if (!resp.ok) throw new Error("Analysis failed");
       
       const data = await resp.json();
@@ -191,6 +193,7 @@ class BossBattle {
       
       const data = await resp.json();
       
+      this.bossId = data.id;
       this.bossImage = data.image;
       this.detections = data.detections;
       
@@ -119,6 +119,7 @@ async function apiGanGenerate(payload) {
 // ========== 1) OBJECT REMOVAL ARENA ==========
 let originalImageData = null; // base64
 let detectedBboxes = []; // from backend
+let originalSize = null; // [w, h] the bboxes refer to (the uploaded image)
 
 const detectInput = document.getElementById("detectImageInput");
 const btnRunDetection = document.getElementById("btnRunDetection");
@@ -145,6 +146,7 @@ btnRunDetection.addEventListener("click", async () => {
   }
   const data = await resp.json();
   detectedBboxes = data.bboxes;
+  originalSize = data.original_size || null;
 
   // Show CLEAN image (no boxes)
   originalImageData = data.annotated_image;
@@ -162,10 +164,14 @@ function drawDetectionBoxes() {
   const img = new Image();
   img.onload = function() {
     detectCtx.drawImage(img, 0, 0);
-    
+
+    // bboxes are in uploaded-image pixels; the image may be downscaled
+    const sx = originalSize ? img.width / originalSize[0] : 1;
+    const sy = originalSize ? img.height / originalSize[1] : 1;
+
     // Now draw boxes for all detections
     detectedBboxes.forEach((bbox, idx) => {
-      const [x1, y1, x2, y2] = bbox.bbox;
+      const [x1, y1, x2, y2] = [bbox.bbox[0] * sx, bbox.bbox[1] * sy, bbox.bbox[2] * sx, bbox.bbox[3] * sy];
       
       // Draw red box
       detectCtx.strokeStyle = "red";
@@ -264,7 +270,8 @@ btnApplyEdits.addEventListener("click", async () => {
 
   const payload = {
     image: originalImageData,
-    actions: actions
+    actions: actions,
+    original_size: originalSize
   };
 
   const resp = await apiObjectEdit(payload);
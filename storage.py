@@ -0,0 +1,258 @@
+# storage.py
+"""Content-addressed file store for uploads and boss images.
+
+Files are named by the SHA-256 of their bytes and sharded two levels deep
+(root/ab/cd/abcd....png), so identical uploads are stored once and no
+directory grows past a few hundred entries. Writes go to a unique temp file
+first, so concurrent uploads (even of the same bytes) never clobber each
+other.
+
+The store keeps an index of its files in memory, ordered by last use, and
+builds it with a single walk at startup. Writes, lookups and garbage
+collection only touch the index, so their cost does not grow with the
+number of files on disk. A store with max_bytes and/or max_age set is
+trimmed by a background thread every GC_INTERVAL seconds (and on writes
+that exceed the size cap): files unused for longer than max_age go first,
+then the least recently used until the store is under 90% of max_bytes.
+A store with neither limit (the boss images) keeps everything.
+
+With several server processes on one directory each collects the files it
+has indexed (everything present at its startup plus its own writes).
+
+Files lying directly in a store's root (from before the store existed) are
+left alone by the server. Move them in once, with the server stopped:
+
+  python storage.py uploads
+"""
+import hashlib
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+GC_INTERVAL = float(os.environ.get("STORE_GC_INTERVAL", "300"))
+
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF8", ".gif"),
+)
+
+
+def sniff_ext(data):
+    """File extension for encoded image bytes (".bin" if unrecognised)."""
+    for magic, ext in _SIGNATURES:
+        if data.startswith(magic):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    return ".bin"
+
+
+class ContentStore:
+    def __init__(self, root, max_bytes=0, max_age=0, gc_interval=GC_INTERVAL):
+        """
+        root: directory of the store (created if missing)
+        max_bytes: size cap in bytes (0 = unlimited)
+        max_age: seconds a file may go unused before it is removed (0 = forever)
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.gc_interval = gc_interval
+        self._files = OrderedDict()  # key -> [ext, size, last_used], least recent first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._gc_thread = None
+        self.writes = 0
+        self.dedup_hits = 0
+        self.expired = 0
+        self.evicted = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    def _path(self, key, ext):
+        return os.path.join(self.root, key[:2], key[2:4], f"{key}{ext}")
+
+    def _scan(self):
+        found = []
+        for shard in os.listdir(self.root):
+            shard_dir = os.path.join(self.root, shard)
+            if len(shard) != 2 or not os.path.isdir(shard_dir):
+                continue
+            for dirpath, _, names in os.walk(shard_dir):
+                for name in names:
+                    key, ext = os.path.splitext(name)
+                    if len(key) != 64 or ext == ".tmp":
+                        continue
+                    try:
+                        st = os.stat(os.path.join(dirpath, name))
+                    except OSError:
+                        continue
+                    found.append((st.st_mtime, key, ext, st.st_size))
+        for mtime, key, ext, size in sorted(found):
+            self._files[key] = [ext, size, mtime]
+            self._bytes += size
+
+    def put(self, data, ext=None):
+        """Store `data` (once per distinct content). Returns its key."""
+        key = hashlib.sha256(data).hexdigest()
+        now = time.time()
+        with self._lock:
+            info = self._files.get(key)
+            if info is not None:
+                info[2] = now
+                self._files.move_to_end(key)
+                self.dedup_hits += 1
+                path = self._path(key, info[0])
+        if info is not None:
+            try:
+                # mtime doubles as the last-use time after a restart
+                os.utime(path)
+                return key
+            except OSError:
+                # removed behind our back; write it again
+                with self._lock:
+                    self._forget(key)
+
+        ext = ext or sniff_ext(data)
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+        with self._lock:
+            if key not in self._files:
+                self._files[key] = [ext, len(data), now]
+                self._bytes += len(data)
+                self.writes += 1
+            over = self.max_bytes and self._bytes > self.max_bytes
+        if over:
+            self.gc()
+        return key
+
+    def adopt(self, path, ext=None):
+        """Move a loose file into the store (deduplicated). Returns its key."""
+        with open(path, "rb") as f:
+            data = f.read()
+        key = self.put(data, ext or os.path.splitext(path)[1].lower() or None)
+        if os.path.abspath(path) != os.path.abspath(self.path(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return key
+
+    def adopt_loose_files(self):
+        """Move files lying directly in root (from before the store) into it."""
+        adopted = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            try:
+                self.adopt(entry.path)
+            except OSError:
+                continue  # taken by another process
+            adopted += 1
+        if adopted:
+            log.info("Moved %d loose files into %s", adopted, self.root)
+        return adopted
+
+    def path(self, key):
+        """Filesystem path of `key`, or None if it is not stored."""
+        with self._lock:
+            info = self._files.get(key)
+            return self._path(key, info[0]) if info is not None else None
+
+    def read(self, key):
+        path = self.path(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._files
+
+    def _forget(self, key):
+        info = self._files.pop(key, None)
+        if info is not None:
+            self._bytes -= info[1]
+        return info
+
+    def _remove(self, key):
+        info = self._forget(key)
+        if info is None:
+            return
+        path = self._path(key, info[0])
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def gc(self):
+        """Apply the age and size limits. Returns the number of files removed."""
+        removed = 0
+        with self._lock:
+            if self.max_age:
+                cutoff = time.time() - self.max_age
+                while self._files:
+                    key, (_, _, last_used) = next(iter(self._files.items()))
+                    if last_used >= cutoff:
+                        break
+                    self._remove(key)
+                    self.expired += 1
+                    removed += 1
+            if self.max_bytes and self._bytes > self.max_bytes:
+                target = int(self.max_bytes * 0.9)
+                while self._files and self._bytes > target:
+                    self._remove(next(iter(self._files)))
+                    self.evicted += 1
+                    removed += 1
+        return removed
+
+    def start_gc(self):
+        """Run gc() every gc_interval seconds on a daemon thread (idempotent)."""
+        if self._gc_thread is not None or not (self.max_bytes or self.max_age):
+            return
+
+        def run():
+            while True:
+                time.sleep(self.gc_interval)
+                try:
+                    removed = self.gc()
+                except Exception as e:
+                    log.warning("Store GC of %s failed: %s", self.root, e)
+                    continue
+                if removed:
+                    log.info("Store GC removed %d files from %s", removed, self.root)
+
+        self._gc_thread = threading.Thread(target=run, name="store-gc", daemon=True)
+        self._gc_thread.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "root": self.root,
+                "files": len(self._files),
+                "mb": round(self._bytes / 2**20, 2),
+                "max_mb": round(self.max_bytes / 2**20, 2),
+                "max_age_hours": round(self.max_age / 3600, 2),
+                "writes": self.writes,
+                "dedup_hits": self.dedup_hits,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    for root in sys.argv[1:] or ["uploads"]:
+        ContentStore(root).adopt_loose_files()